@@ -11,7 +11,8 @@ from flask.ext.mongoengine import MongoEngine
 from flask.ext.sqlalchemy import SQLAlchemy
 
 from flask.ext.security import (Security, LoginForm, user_datastore, 
-                                login_required, roles_required, roles_accepted)
+                                login_required, roles_required, roles_accepted,
+                                http_auth_required, current_user)
 
 from flask.ext.security.datastore.sqlalchemy import SQLAlchemyUserDatastore
 from flask.ext.security.datastore.mongoengine import MongoEngineUserDatastore
@@ -72,11 +73,21 @@ def create_app(auth_config):
     def admin():
         return render_template('index.html', content='Admin Page')
     
+    @app.route('/editor')
+    @roles_required('editor')
+    def editor():
+        return render_template('index.html', content='Editor Page')
+    
     @app.route('/admin_or_editor')
     @roles_accepted('admin', 'editor')
     def admin_or_editor():
         return render_template('index.html', content='Admin or Editor Page')
     
+    @app.route('/http')
+    @http_auth_required
+    def http():
+        return 'HTTP Authentication: %s' % current_user.username
+    
     return app
 
 def create_sqlalchemy_app(auth_config=None):
@@ -111,13 +122,13 @@ def create_mongoengine_app(auth_config=None):
         first_name = db.StringField(max_length=120)
         last_name = db.StringField(max_length=120)
 
-    Security(app, MongoEngineUserDatastore(db, UserAccountMixin))
+    datastore = MongoEngineUserDatastore(db, UserAccountMixin)
+    Security(app, datastore)
     
     @app.before_first_request
     def before_first_request():
-        from flask.ext.security import User, Role
-        User.drop_collection()
-        Role.drop_collection()
+        datastore.User.drop_collection()
+        datastore.Role.drop_collection()
         populate_data()
         
     return app
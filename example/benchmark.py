@@ -0,0 +1,81 @@
+"""
+    Benchmark of the request paths of the example application
+
+    Measures the overhead of the `login_required`, `roles_required` and
+    `roles_accepted` decorators around a trivial view, granted and denied, of
+    `AuthenticationProvider.do_authenticate`, and of a complete login request
+    through the test client. Example::
+
+        $ python example/benchmark.py --number 20000
+"""
+
+# a little trick so you can run:
+# $ python example/benchmark.py
+# from the root of the security project
+import sys, os
+sys.path.pop(0)
+sys.path.insert(0, os.getcwd())
+
+import argparse
+
+from time import time
+
+from flask.ext.security import (login_required, roles_required,
+                                roles_accepted, auth_provider)
+
+from example import app
+
+
+def view():
+    return 'ok'
+
+DECORATED = (
+    ('login_required', login_required(view)),
+    ('roles_required', roles_required('admin')(view)),
+    ('roles_accepted', roles_accepted('editor', 'admin')(view)),
+    ('roles_required (denied)', roles_required('editor')(view)),
+)
+
+
+def measure(fn, number):
+    """Returns the mean duration of a call in microseconds"""
+    fn()
+    start = time()
+    for i in xrange(number):
+        fn()
+    return (time() - start) / number * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the example app')
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='number of calls per measurement')
+    args = parser.parse_args()
+
+    application = app.create_sqlalchemy_app()
+    application.debug = False
+    results = []
+
+    with application.test_client() as client:
+        client.get('/')
+        client.post('/auth', data=dict(username='matt', password='password'))
+        # the request context of the login stays active for the decorators
+        client.get('/profile')
+        for name, fn in DECORATED:
+            results.append((name, measure(fn, args.number)))
+        results.append(('do_authenticate', measure(
+            lambda: auth_provider.do_authenticate('matt', 'password'),
+            args.number // 10)))
+
+    def login():
+        with application.test_client() as client:
+            client.post('/auth', data=dict(username='matt',
+                                           password='password'))
+    results.append(('POST /auth', measure(login, args.number // 10)))
+
+    for name, duration in results:
+        print '%-24s %10.2f us' % (name, duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+    Load test for the example application
+
+    Simulates concurrent users that log in, browse the pages protected by
+    `login_required`, `roles_required` and `roles_accepted`, and log out. Each
+    simulated user has its own cookie session. By default the SQLite example
+    application is served by a threaded server in this process, use `--url` to
+    target an application served elsewhere, e.g. by gunicorn. Example::
+
+        $ python example/loadtest.py --users 20 --iterations 25 --hash bcrypt
+
+    Throughput and the 50th, 95th and 99th percentile latencies are reported
+    for each endpoint.
+"""
+
+# a little trick so you can run:
+# $ python example/loadtest.py
+# from the root of the security project
+import sys, os
+sys.path.pop(0)
+sys.path.insert(0, os.getcwd())
+
+import argparse
+import re
+import threading
+import urllib
+import urllib2
+
+from cookielib import CookieJar
+from time import time
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from example import app
+
+#: The active users of the example application and the pages they browse
+CREDENTIALS = (('matt', 'password'), ('joe', 'password'), ('jill', 'password'))
+PAGES = ('/', '/admin', '/editor', '/admin_or_editor')
+
+CSRF_RE = re.compile(r'name="csrf" type="hidden" value="([^"]*)"')
+
+
+class NoRedirectHandler(urllib2.HTTPRedirectHandler):
+    # redirects are measured as responses of the endpoint that issued them
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Stats(object):
+    """Collects the latencies and failures of the requests to each endpoint"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, latency, error=False):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if error:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        lines = ['%-26s %8s %7s %9s %9s %9s %9s' % (
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms')]
+        everything = []
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            everything.extend(latencies)
+            lines.append(self._line(endpoint, latencies,
+                                    self.errors.get(endpoint, 0), elapsed))
+        lines.append(self._line('total', sorted(everything),
+                                sum(self.errors.values()), elapsed))
+        return '\n'.join(lines)
+
+    def _line(self, endpoint, latencies, errors, elapsed):
+        return '%-26s %8d %7d %9.1f %9.2f %9.2f %9.2f' % (
+            endpoint, len(latencies), errors, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000)
+
+
+def percentile(values, p):
+    """Returns the nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0
+    return values[max(0, min(len(values) - 1,
+                             int(round(p / 100.0 * len(values))) - 1))]
+
+
+class SimulatedUser(threading.Thread):
+    """A user that logs in, browses the protected pages and logs out
+    `iterations` times.
+
+    :param base_url: The URL of the application
+    :param username: The username to log in with
+    :param password: The password to log in with
+    :param iterations: The number of sessions
+    :param stats: The :class:`Stats` to record requests in
+    """
+
+    def __init__(self, base_url, username, password, iterations, stats):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.base_url = base_url.rstrip('/')
+        self.username, self.password = username, password
+        self.iterations = iterations
+        self.stats = stats
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(CookieJar()), NoRedirectHandler())
+
+    def request(self, method, path, data=None, expected=(200, 302)):
+        endpoint = '%s %s' % (method, path)
+        if data is not None:
+            data = urllib.urlencode(data)
+        start = time()
+        try:
+            response = self.opener.open(self.base_url + path, data)
+            status, body = response.code, response.read()
+        except urllib2.HTTPError, e:
+            status, body = e.code, e.read()
+        except Exception:
+            status, body = None, ''
+        self.stats.add(endpoint, time() - start, status not in expected)
+        return status, body
+
+    def run(self):
+        for i in xrange(self.iterations):
+            status, body = self.request('GET', '/login')
+            data = dict(username=self.username, password=self.password)
+            match = CSRF_RE.search(body)
+            if match:
+                data['csrf'] = match.group(1)
+            self.request('POST', '/auth', data, expected=(302,))
+            # only a logged in user gets the profile page
+            self.request('GET', '/profile', expected=(200,))
+            for page in PAGES:
+                self.request('GET', page)
+            self.request('GET', '/logout', expected=(302,))
+
+
+def serve(auth_config):
+    """Serves the SQLite example application from a background thread and
+    returns its URL"""
+    application = app.create_sqlalchemy_app(auth_config)
+    application.debug = False
+    server = make_server('127.0.0.1', 0, application, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the example app')
+    parser.add_argument('-u', '--users', type=int, default=10,
+                        help='number of concurrent simulated users')
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help='number of sessions per simulated user')
+    parser.add_argument('--hash', default=None,
+                        help='SECURITY_PASSWORD_HASH of the served app')
+    parser.add_argument('--url', default=None,
+                        help='URL of an already running example app')
+    args = parser.parse_args()
+
+    auth_config = {'SECURITY_PASSWORD_HASH': args.hash} if args.hash else None
+    base_url = args.url or serve(auth_config)
+
+    # the first request creates and populates the database
+    urllib2.urlopen(base_url + '/').read()
+
+    stats = Stats()
+    users = [SimulatedUser(base_url, username, password, args.iterations, stats)
+             for username, password in
+             (CREDENTIALS[i % len(CREDENTIALS)] for i in xrange(args.users))]
+
+    start = time()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time() - start
+
+    print '%d users x %d sessions against %s in %.2fs' % (
+        args.users, args.iterations, base_url, elapsed)
+    print stats.report(elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,9 @@
 
 __version__ = '1.2.1'
 
+import inspect
+import json
+import os
 import sys
 
 from datetime import datetime
@@ -35,6 +38,8 @@ from passlib.context import CryptContext
 from werkzeug.utils import import_string
 from werkzeug.local import LocalProxy
 
+from flask.ext.security.profiling import AuthProfiler, auth_phase
+
 class User(object):
     """User model"""
 
@@ -52,12 +57,45 @@ LOGIN_VIEW_KEY =     'SECURITY_LOGIN_VIEW'
 POST_LOGIN_KEY =     'SECURITY_POST_LOGIN'
 POST_LOGOUT_KEY =    'SECURITY_POST_LOGOUT'
 FLASH_MESSAGES_KEY = 'SECURITY_FLASH_MESSAGES'
+ENSURE_INDEXES_KEY = 'SECURITY_ENSURE_INDEXES'
+SESSION_LOAD_FIELDS_KEY = 'SECURITY_SESSION_LOAD_FIELDS'
+USER_CACHE_KEY =     'SECURITY_USER_CACHE'
+USER_CACHE_OPTIONS_KEY = 'SECURITY_USER_CACHE_OPTIONS'
+ROLE_BITMASK_KEY =   'SECURITY_ROLE_BITMASK'
+ROLE_HIERARCHY_TTL_KEY = 'SECURITY_ROLE_HIERARCHY_TTL'
+TRACKABLE_KEY =      'SECURITY_TRACKABLE'
+TRACKABLE_FLUSH_INTERVAL_KEY = 'SECURITY_TRACKABLE_FLUSH_INTERVAL'
+TRACKABLE_BUFFER_SIZE_KEY = 'SECURITY_TRACKABLE_BUFFER_SIZE'
+EXEMPT_ROUTES_KEY =  'SECURITY_EXEMPT_ROUTES'
+JSON_AUTH_URL_KEY =  'SECURITY_JSON_AUTH_URL'
+JSON_LOGOUT_URL_KEY = 'SECURITY_JSON_LOGOUT_URL'
+SLOW_AUTH_THRESHOLD_KEY = 'SECURITY_SLOW_AUTH_THRESHOLD'
+SLOW_AUTH_LOG_KEY = 'SECURITY_SLOW_AUTH_LOG'
+AUTH_PROFILE_RATE_KEY = 'SECURITY_AUTH_PROFILE_RATE'
+AUTH_PROFILE_DIR_KEY = 'SECURITY_AUTH_PROFILE_DIR'
+CACHE_WARMUP_KEY =   'SECURITY_CACHE_WARMUP'
+CACHE_WARMUP_USERS_KEY = 'SECURITY_CACHE_WARMUP_USERS'
+CACHE_WARMUP_TIMEOUT_KEY = 'SECURITY_CACHE_WARMUP_TIMEOUT'
+HTTP_AUTH_REALM_KEY = 'SECURITY_HTTP_AUTH_REALM'
+CREDENTIAL_CACHE_TTL_KEY = 'SECURITY_CREDENTIAL_CACHE_TTL'
+CREDENTIAL_CACHE_SIZE_KEY = 'SECURITY_CREDENTIAL_CACHE_SIZE'
+INVALIDATION_BUS_KEY = 'SECURITY_INVALIDATION_BUS'
+INVALIDATION_BUS_OPTIONS_KEY = 'SECURITY_INVALIDATION_BUS_OPTIONS'
+DETACHED_USER_KEY =  'SECURITY_DETACHED_USER'
 
 DEBUG_LOGIN = 'User %s logged in. Redirecting to: %s'
 ERROR_LOGIN = 'Unsuccessful authentication attempt: %s. Redirecting to: %s'
 DEBUG_LOGOUT = 'User logged out, redirecting to: %s'
+DEBUG_JSON_LOGIN = 'User %s logged in'
+ERROR_JSON_LOGIN = 'Unsuccessful authentication attempt: %s'
 FLASH_INACTIVE = 'Inactive user'
 FLASH_PERMISSIONS = 'You do not have permission to view this resource.'
+ERROR_JSON_REQUEST = 'Request body must be a JSON object'
+ERROR_JSON_LOGOUT = 'Request must set the X-Requested-With header'
+ERROR_USERNAME = 'Username not provided'
+ERROR_PASSWORD = 'Password not provided'
+ERROR_HTTP_AUTH = 'Authentication required'
+ERROR_HTTP_LOGIN = 'Unsuccessful HTTP authentication attempt: %s'
 
 #: Default Flask-Security configuration
 default_config = {
@@ -72,6 +110,31 @@ default_config = {
     LOGIN_VIEW_KEY:     '/login',
     POST_LOGIN_KEY:     '/',
     POST_LOGOUT_KEY:    '/',
+    ENSURE_INDEXES_KEY: True,
+    SESSION_LOAD_FIELDS_KEY: None,
+    USER_CACHE_KEY:     None,
+    USER_CACHE_OPTIONS_KEY: {},
+    ROLE_BITMASK_KEY:   False,
+    ROLE_HIERARCHY_TTL_KEY: 60,
+    TRACKABLE_KEY:      False,
+    TRACKABLE_FLUSH_INTERVAL_KEY: 5,
+    TRACKABLE_BUFFER_SIZE_KEY: 100,
+    EXEMPT_ROUTES_KEY:  [],
+    JSON_AUTH_URL_KEY:  None,
+    JSON_LOGOUT_URL_KEY: None,
+    SLOW_AUTH_THRESHOLD_KEY: None,
+    SLOW_AUTH_LOG_KEY: None,
+    AUTH_PROFILE_RATE_KEY: 0,
+    AUTH_PROFILE_DIR_KEY: None,
+    CACHE_WARMUP_KEY:   False,
+    CACHE_WARMUP_USERS_KEY: 1000,
+    CACHE_WARMUP_TIMEOUT_KEY: 30,
+    HTTP_AUTH_REALM_KEY: 'Login Required',
+    CREDENTIAL_CACHE_TTL_KEY: 0,
+    CREDENTIAL_CACHE_SIZE_KEY: 10000,
+    INVALIDATION_BUS_KEY: None,
+    INVALIDATION_BUS_OPTIONS_KEY: {},
+    DETACHED_USER_KEY:  False,
 }
 
 
@@ -116,18 +179,29 @@ class RoleCreationError(Exception):
 #: App logger for convenience
 logger = LocalProxy(lambda: current_app.logger)
 
+def _get_state():
+    # a single lookup of the state of the current application, which also 
+    # works in an application context without a request
+    return current_app._get_current_object().security
+
+def _find_state():
+    # the state of the current application, or None outside of its contexts
+    try:
+        return _get_state()
+    except (AttributeError, RuntimeError):
+        return None
+
 #: Authentication provider
-auth_provider = LocalProxy(lambda: current_app.auth_provider)
+auth_provider = LocalProxy(lambda: _get_state().auth_provider)
 
 #: Login manager
-login_manager = LocalProxy(lambda: current_app.login_manager)
+login_manager = LocalProxy(lambda: _get_state().login_manager)
 
 #: Password encyption context
-pwd_context = LocalProxy(lambda: current_app.pwd_context)
+pwd_context = LocalProxy(lambda: _get_state().pwd_context)
 
 #: User datastore
-user_datastore = LocalProxy(lambda: getattr(current_app, 
-    current_app.config[USER_DATASTORE_KEY]))
+user_datastore = LocalProxy(lambda: _get_state().datastore)
 
 def roles_required(*args):
     """View decorator which specifies that a user must have all the specified
@@ -144,18 +218,23 @@ def roles_required(*args):
     :param args: The required roles. 
     """
     roles = args
-    perm = Permission(*[RoleNeed(role) for role in roles])
+    needs = frozenset([RoleNeed(role) for role in roles])
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            if not current_user.is_authenticated():
-                return redirect(current_app.config[LOGIN_VIEW_KEY])
+            # the request context is looked up once instead of through the
+            # current_user, g and current_app proxies
+            ctx = _request_ctx_stack.top
+            state = ctx.app.security
+            if not ctx.user.is_authenticated():
+                return redirect(
+                    state.redirect_resolver.config_url(LOGIN_VIEW_KEY))
             
-            if perm.can():
+            if needs.issubset(ctx.g.identity.provides):
                 return fn(*args, **kwargs)
             
-            logger.debug('Identity does not provide all of the '
-                         'following roles: %s' % [r for r in roles])
+            state.logger.debug('Identity does not provide all of the '
+                               'following roles: %s' % [r for r in roles])
             
             do_flash(FLASH_PERMISSIONS, 'error')
             return redirect(request.referrer or '/')
@@ -178,19 +257,21 @@ def roles_accepted(*args):
     :param args: The possible roles. 
     """
     roles = args
-    perms = [Permission(RoleNeed(role)) for role in roles]
+    needs = frozenset([RoleNeed(role) for role in roles])
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            if not current_user.is_authenticated():
-                return redirect(current_app.config[LOGIN_VIEW_KEY])
+            ctx = _request_ctx_stack.top
+            state = ctx.app.security
+            if not ctx.user.is_authenticated():
+                return redirect(
+                    state.redirect_resolver.config_url(LOGIN_VIEW_KEY))
             
-            for perm in perms:
-                if perm.can():
-                    return fn(*args, **kwargs)
+            if not needs.isdisjoint(ctx.g.identity.provides):
+                return fn(*args, **kwargs)
                 
-            logger.debug('Identity does not provide at least one of '
-                         'the following roles: %s' % [r for r in roles])
+            state.logger.debug('Identity does not provide at least one of '
+                               'the following roles: %s' % [r for r in roles])
             
             do_flash(FLASH_PERMISSIONS, 'error')
             return redirect(request.referrer or '/')
@@ -198,6 +279,97 @@ def roles_accepted(*args):
     return wrapper
 
 
+def http_auth_required(fn):
+    """View decorator which authenticates the user with the credentials sent
+    with the request using HTTP Basic authentication. No session is started, 
+    the credentials are verified on every request. Example::
+    
+        @app.route('/api/documents')
+        @http_auth_required
+        def documents():
+            return json.dumps([d.title for d in Document.query.all()])
+            
+    Requests without valid credentials of an active user get a `401` 
+    response. Set `SECURITY_CREDENTIAL_CACHE_TTL` so that repeated requests 
+    with the same credentials are not verified against the password hash 
+    every time.
+    
+    :param fn: The view function
+    """
+    @wraps(fn)
+    def decorated_view(*args, **kwargs):
+        ctx = _request_ctx_stack.top
+        state = ctx.app.security
+        auth = ctx.request.authorization
+        if auth is not None and auth.username and auth.password:
+            try:
+                user = state.auth_provider.do_authenticate(auth.username, 
+                                                           auth.password)
+            except BadCredentialsError, e:
+                state.logger.debug(ERROR_HTTP_LOGIN % e)
+                user = None
+            
+            if user is not None and user.is_active():
+                ctx.user = user
+                ctx.g.identity = identity = Identity(user.get_id(), 'basic')
+                identity_loaded.send(ctx.app, identity=identity)
+                return fn(*args, **kwargs)
+        
+        realm = state.http_auth_realm.replace('"', '')
+        return ctx.app.response_class(ERROR_HTTP_AUTH, status=401, headers={
+            'WWW-Authenticate': 'Basic realm="%s"' % realm})
+    return decorated_view
+
+
+def filter_permitted(items, roles_for):
+    """Returns the list of items the current identity is permitted to access.
+    The roles provided by the identity are computed once and each distinct 
+    role requirement is only evaluated once. Example::
+    
+        @app.route('/documents')
+        @login_required
+        def documents():
+            docs = filter_permitted(Document.query.all(), 
+                                    lambda doc: doc.required_roles)
+            return render_template('documents.html', docs=docs)
+            
+    :param items: An iterable of items
+    :param roles_for: A function that returns the role sets required for an 
+                      item. The item is permitted if the identity provides all
+                      of the roles of at least one of the sets. A set can be a
+                      single role name. `None` means no roles are required.
+    """
+    provided = frozenset([need.value for need in g.identity.provides 
+                          if need.method == 'role'])
+    permitted, results = [], {}
+    for item in items:
+        role_sets = roles_for(item)
+        if role_sets is None:
+            permitted.append(item)
+            continue
+        key = frozenset([frozenset([rs]) if isinstance(rs, basestring) 
+                         else frozenset(rs) for rs in role_sets])
+        result = results.get(key)
+        if result is None:
+            result = results[key] = any(rs <= provided for rs in key)
+        if result:
+            permitted.append(item)
+    return permitted
+
+
+def get_effective_roles(roles):
+    """Returns the names of the specified roles and of all the roles they 
+    imply through the role hierarchy of the current application's user 
+    datastore.
+    
+    :param roles: An iterable of role names
+    """
+    state = _find_state()
+    if state is None:
+        return frozenset(roles)
+    return state.datastore.get_effective_roles(roles)
+
+
 class RoleMixin(object):
     """Mixin for `Role` model definitions"""
     def __eq__(self, other):
@@ -213,17 +385,40 @@ class RoleMixin(object):
 class UserMixin(BaseUserMixin):
     """Mixin for `User` model definitions"""
     
+    #: The prefix of the IDs returned by :meth:`get_id`. Set on the models of 
+    #: the shards of a sharded datastore so that IDs are unique across shards
+    id_prefix = None
+    
+    def get_id(self):
+        """Returns the ID of the user stored in the session"""
+        if self.id_prefix is None:
+            return BaseUserMixin.get_id(self)
+        return u'%s%s' % (self.id_prefix, self.id)
+    
     def is_active(self):
         """Returns `True` if the user is active.""" 
         return self.active
     
+    def get_role_names(self):
+        """Returns the names of the roles assigned to the user. When
+        `SECURITY_ROLE_BITMASK` is enabled the names are decoded from the 
+        user's role mask without loading its roles."""
+        state = _find_state()
+        if state is not None and state.datastore.role_bitmask:
+            return state.datastore.get_role_names(self.role_mask or 0)
+        return [r.name for r in self.roles]
+    
     def has_role(self, role):
-        """Returns `True` if the user identifies with the specified role.
+        """Returns `True` if the user identifies with the specified role, 
+        either directly or through a role implied by one of its roles.
         
         :param role: A role name or `Role` instance"""
-        if not isinstance(role, Role):
-            role = Role(name=role)
-        return role in self.roles
+        if isinstance(role, RoleMixin):
+            role = role.name
+        state = _find_state()
+        if state is not None and state.datastore.role_bitmask:
+            return state.datastore.mask_has_role(self.role_mask or 0, role)
+        return role in get_effective_roles(self.get_role_names())
     
     def __str__(self):
         ctx = (str(self.id), self.username, self.email)
@@ -235,11 +430,171 @@ class AnonymousUser(AnonymousUserBase):
         super(AnonymousUser, self).__init__()
         self.roles = [] # TODO: Make this immutable?
         
+    def get_role_names(self):
+        """Returns an empty list"""
+        return []
+        
     def has_role(self, *args):
         """Returns `False`"""
         return False
 
 
+class RoleSnapshot(RoleMixin):
+    """A detached copy of a role that only knows its name"""
+    
+    def __init__(self, name, description=None):
+        self.name = name
+        self.description = description
+
+
+class UserSnapshot(object):
+    """An immutable copy of the attributes of a user that are needed to 
+    establish its identity, detached from the datastore. It implements the 
+    interface of :class:`UserMixin` with slots instead of a model instance. 
+    When `SECURITY_USER_CACHE` is configured or `SECURITY_DETACHED_USER` is 
+    enabled the current user is a snapshot.
+    """
+    
+    __slots__ = ('id', 'username', 'email', 'active', 'role_names')
+    
+    def __init__(self, id, username, email, active, roles):
+        set = object.__setattr__
+        set(self, 'id', id)
+        set(self, 'username', username)
+        set(self, 'email', email)
+        set(self, 'active', active)
+        set(self, 'role_names', tuple(roles))
+        
+    def __setattr__(self, name, value):
+        raise AttributeError("UserSnapshot is immutable, modify the model "
+                             "returned by get_model instead")
+    
+    __delattr__ = __setattr__
+    
+    @property
+    def roles(self):
+        """Role snapshots that only know their name"""
+        return [RoleSnapshot(name) for name in self.role_names]
+    
+    def is_authenticated(self):
+        """Returns `True`"""
+        return True
+    
+    def is_active(self):
+        """Returns `True` if the user is active.""" 
+        return self.active
+    
+    def is_anonymous(self):
+        """Returns `False`"""
+        return False
+    
+    def get_id(self):
+        """Returns the ID of the user stored in the session"""
+        return unicode(self.id)
+    
+    def get_role_names(self):
+        """Returns the names of the roles assigned to the user"""
+        return self.role_names
+    
+    def has_role(self, role):
+        """Returns `True` if the user identifies with the specified role, 
+        either directly or through a role implied by one of its roles.
+        
+        :param role: A role name or `Role` instance"""
+        if isinstance(role, RoleMixin):
+            role = role.name
+        return role in get_effective_roles(self.role_names)
+    
+    @classmethod
+    def from_user(cls, user):
+        """Returns a snapshot of the specified user.
+        
+        :param user: A `User` instance"""
+        return cls(**cls.to_dict(user))
+    
+    @staticmethod
+    def to_dict(user):
+        """Returns the snapshot attributes of a user as a dictionary suitable
+        for storing in a cache.
+        
+        :param user: A `User` or `UserSnapshot` instance"""
+        id = user.id if getattr(user, 'id_prefix', None) is None \
+             else user.get_id()
+        return dict(id=id, username=user.username, email=user.email,
+                    active=user.active, roles=list(user.get_role_names()))
+    
+    def get_model(self):
+        """Loads and returns the complete `User` instance from the user 
+        datastore."""
+        return user_datastore.with_id(self.id)
+    
+    def __str__(self):
+        ctx = (str(self.id), self.username, self.email)
+        return '<User id=%s, username=%s, email=%s>' % ctx
+
+
+class ExemptRoutes(object):
+    """Matches the requests for which the current user and identity are not 
+    loaded. 
+    
+    :param routes: A list of endpoint names, blueprint names followed by a 
+                   period, e.g. `'api.'`, and URL prefixes starting with a 
+                   slash, e.g. `'/static'`
+    """
+    def __init__(self, routes):
+        self.endpoints = frozenset([r for r in routes 
+                                    if not r.startswith('/') 
+                                    and not r.endswith('.')])
+        self.blueprints = frozenset([r[:-1] for r in routes if r.endswith('.')])
+        # prefixes match whole path segments, '/public' does not match
+        # '/publication'
+        self.prefixes = frozenset([r.rstrip('/') for r in routes 
+                                   if r.startswith('/')])
+        self._prefix_dirs = tuple([p + '/' for p in self.prefixes])
+        
+    def __nonzero__(self):
+        return bool(self.endpoints or self.blueprints or self.prefixes)
+    
+    def match(self, request):
+        """Returns `True` if the specified request is exempt.
+        
+        :param request: A request"""
+        endpoint = request.endpoint
+        if endpoint is not None:
+            if endpoint in self.endpoints:
+                return True
+            if '.' in endpoint and endpoint.rsplit('.', 1)[0] in self.blueprints:
+                return True
+        if not self.prefixes:
+            return False
+        path = request.path
+        return path in self.prefixes or path.startswith(self._prefix_dirs)
+
+
+class _LoginManager(LoginManager):
+    """Login manager that does not load the user of exempt requests"""
+    
+    exempt_routes = None
+    
+    def _load_user(self):
+        if self.exempt_routes and self.exempt_routes.match(request):
+            _request_ctx_stack.top.user = self.anonymous_user()
+            return
+        return LoginManager._load_user(self)
+
+
+class SecurityState(object):
+    """The state of the extension for an application: its configured services
+    and the configuration values read on every request. Created by 
+    :meth:`Security.init_app` and available as `app.security` so that the 
+    request paths reach all of them with a single lookup.
+    """
+    
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
 class Security(object):
     """The :class:`Security` class initializes the Flask-Security extension.
     
@@ -269,8 +624,11 @@ class Security(object):
         app.config.update(configured)
         config = app.config
         
+        exempt_routes = ExemptRoutes(config[EXEMPT_ROUTES_KEY])
+        
         # setup the login manager extension
-        login_manager = LoginManager()
+        login_manager = _LoginManager()
+        login_manager.exempt_routes = exempt_routes
         login_manager.anonymous_user = AnonymousUser
         login_manager.login_view = config[LOGIN_VIEW_KEY]
         login_manager.setup_app(app)
@@ -281,43 +639,146 @@ class Security(object):
         pw_hash = config[PASSWORD_HASH_KEY]
         
         app.pwd_context = CryptContext(schemes=[pw_hash], default=pw_hash)
+        app.redirect_resolver = RedirectResolver(app)
         app.auth_provider = Provider(Form)
         app.principal = Principal(app)
         
+        app.security = state = SecurityState(
+            app=app, datastore=datastore, auth_provider=app.auth_provider,
+            login_manager=login_manager, pwd_context=app.pwd_context,
+            redirect_resolver=app.redirect_resolver, logger=app.logger,
+            flash_messages=config[FLASH_MESSAGES_KEY],
+            http_auth_realm=config[HTTP_AUTH_REALM_KEY], 
+            credential_cache=None, api_key_tracker=None)
+        
+        if config[CREDENTIAL_CACHE_TTL_KEY]:
+            from flask.ext.security.cache import CredentialCache
+            state.credential_cache = CredentialCache(
+                config[CREDENTIAL_CACHE_TTL_KEY], 
+                config[CREDENTIAL_CACHE_SIZE_KEY])
+        
+        # the module attributes are kept for backwards compatibility, they 
+        # refer to the models of the most recently initialized application
         from flask.ext import security as s
-        s.User, s.Role = datastore.get_models()
+        s.User, s.Role = datastore.init_models()
         
         setattr(app, config[USER_DATASTORE_KEY], datastore)
         
+        if config[USER_CACHE_KEY]:
+            Cache = get_class_from_config(USER_CACHE_KEY, config)
+            datastore.user_cache = Cache(**get_cache_options(
+                Cache, config[USER_CACHE_OPTIONS_KEY], app, datastore))
+        
+        datastore.role_bitmask = config[ROLE_BITMASK_KEY]
+        datastore.role_hierarchy_ttl = config[ROLE_HIERARCHY_TTL_KEY]
+        
+        if config[SESSION_LOAD_FIELDS_KEY] is not None:
+            datastore.session_load_fields = tuple(
+                config[SESSION_LOAD_FIELDS_KEY])
+        elif datastore.role_bitmask:
+            datastore.session_load_fields = tuple(
+                [f for f in datastore.session_load_fields if f != 'roles'] + 
+                ['role_mask'])
+        
+        if config[ENSURE_INDEXES_KEY]:
+            datastore.ensure_indexes()
+        
+        if config[TRACKABLE_KEY]:
+            from flask.ext.security.tracking import LoginTracker
+            app.login_tracker = LoginTracker(app, datastore, 
+                config[TRACKABLE_FLUSH_INTERVAL_KEY], 
+                config[TRACKABLE_BUFFER_SIZE_KEY])
+            
+            @user_logged_in.connect_via(app)
+            def on_user_logged_in(sender, user):
+                app.login_tracker.record(user.get_id(), request.remote_addr)
+        
+        if config[INVALIDATION_BUS_KEY]:
+            Bus = get_class_from_config(INVALIDATION_BUS_KEY, config)
+            datastore.invalidation_bus = bus = Bus(**get_bus_options(
+                Bus, config[INVALIDATION_BUS_OPTIONS_KEY], app))
+            
+            @bus.subscribe
+            def on_invalidation(kind, keys):
+                try:
+                    datastore.evict(kind, keys)
+                    if kind == 'user' and state.credential_cache is not None:
+                        for id in keys:
+                            state.credential_cache.discard_user(id)
+                except Exception, e:
+                    state.logger.error('Error evicting %ss %s: %s' % (
+                        kind, keys, e))
+            
+            app.before_request(bus.listen)
+        
+        if issubclass(Provider, ApiKeyAuthenticationProvider):
+            from flask.ext.security.tracking import ApiKeyTracker
+            state.api_key_tracker = ApiKeyTracker(app, datastore, 
+                config[TRACKABLE_FLUSH_INTERVAL_KEY], 
+                config[TRACKABLE_BUFFER_SIZE_KEY])
+        
+        if config[CACHE_WARMUP_KEY]:
+            from flask.ext.security.warmup import CacheWarmer
+            app.cache_warmer = CacheWarmer(app, datastore, 
+                config[CACHE_WARMUP_USERS_KEY], 
+                config[CACHE_WARMUP_TIMEOUT_KEY])
+            app.before_request(app.cache_warmer.ensure_started)
+            if not config[TRACKABLE_KEY]:
+                state.logger.warning('%s ranks users by their last login, '
+                    'which is only recorded with %s. No users will be '
+                    'preloaded unless they are tracked otherwise' % (
+                    CACHE_WARMUP_KEY, TRACKABLE_KEY))
+        
         @identity_loaded.connect_via(app)
         def on_identity_loaded(sender, identity):
+            if exempt_routes and exempt_routes.match(request):
+                return
+            
             if hasattr(current_user, 'id'):
-                identity.provides.add(UserNeed(current_user.id))
+                identity.provides.add(UserNeed(current_user.get_id()))
                 
-            for role in current_user.roles:
-                identity.provides.add(RoleNeed(role.name))
+            roles = get_effective_roles(current_user.get_role_names())
+            identity.provides.update([RoleNeed(name) for name in roles])
             
             identity.user = current_user
         
+        detached = config[DETACHED_USER_KEY]
+        
         @login_manager.user_loader
         def load_user(user_id):
             try: 
-                return datastore.with_id(user_id)
+                if datastore.user_cache is not None:
+                    return datastore.load_user_snapshot(user_id)
+                user = datastore.load_user(user_id)
+                return UserSnapshot.from_user(user) if detached else user
             except Exception, e:
-                logger.error('Error getting user: %s' % e) 
+                state.logger.error('Error getting user: %s' % e) 
                 return None
             
+        profiler = AuthProfiler(config[SLOW_AUTH_THRESHOLD_KEY],
+                                config[SLOW_AUTH_LOG_KEY],
+                                config[AUTH_PROFILE_RATE_KEY],
+                                config[AUTH_PROFILE_DIR_KEY])
+        instrument = profiler if profiler else (lambda fn: fn)
+            
         auth_url = config[AUTH_URL_KEY]
         @blueprint.route(auth_url, methods=['POST'], endpoint='authenticate')
+        @instrument
         def authenticate():
             try:
-                form = Form()
-                user = auth_provider.authenticate(form)
+                with auth_phase('form'):
+                    form = Form()
+                user = state.auth_provider.authenticate(form)
                 
-                if login_user(user, remember=form.remember.data):
+                with auth_phase('login_user'):
+                    logged_in = login_user(user, remember=form.remember.data)
+                
+                if logged_in:
                     redirect_url = get_post_login_redirect()
-                    identity_changed.send(app, identity=Identity(user.id))
-                    logger.debug(DEBUG_LOGIN % (user, redirect_url))
+                    with auth_phase('identity_changed'):
+                        identity_changed.send(
+                            app, identity=Identity(user.get_id()))
+                    state.logger.debug(DEBUG_LOGIN % (user, redirect_url))
                     return redirect(redirect_url)
 
                 raise BadCredentialsError(FLASH_INACTIVE)
@@ -325,23 +786,77 @@ class Security(object):
             except BadCredentialsError, e:
                 message = '%s' % e
                 do_flash(message, 'error')
-                redirect_url = request.referrer or login_manager.login_view
-                logger.error(ERROR_LOGIN % (message, redirect_url))
+                redirect_url = (request.referrer or 
+                    state.redirect_resolver.config_url(LOGIN_VIEW_KEY))
+                state.logger.error(ERROR_LOGIN % (message, redirect_url))
                 return redirect(redirect_url)
     
-        @blueprint.route(config[LOGOUT_URL_KEY], endpoint='logout')
-        @login_required
-        def logout():
+        def do_logout():
             for value in ('identity.name', 'identity.auth_type'):
                 session.pop(value, None)
             
             identity_changed.send(app, identity=AnonymousIdentity())
             logout_user()
+        
+        @blueprint.route(config[LOGOUT_URL_KEY], endpoint='logout')
+        @login_required
+        def logout():
+            do_logout()
             
             redirect_url = find_redirect(POST_LOGOUT_KEY)
-            logger.debug(DEBUG_LOGOUT % redirect_url)
+            state.logger.debug(DEBUG_LOGOUT % redirect_url)
             return redirect(redirect_url)
         
+        if config[JSON_AUTH_URL_KEY]:
+            @blueprint.route(config[JSON_AUTH_URL_KEY], methods=['POST'], 
+                             endpoint='json_authenticate')
+            @instrument
+            def json_authenticate():
+                data = request.json
+                if not isinstance(data, dict):
+                    return json_response({'error': ERROR_JSON_REQUEST}, 400)
+                
+                username, password = data.get('username'), data.get('password')
+                if not all(isinstance(value, basestring) for value in 
+                           (username or '', password or '')):
+                    return json_response({'error': ERROR_JSON_REQUEST}, 400)
+                if not username or not password:
+                    error = ERROR_PASSWORD if username else ERROR_USERNAME
+                    return json_response({'error': error}, 400)
+                
+                try:
+                    user = state.auth_provider.do_authenticate(username, 
+                                                               password)
+                except BadCredentialsError, e:
+                    state.logger.error(ERROR_JSON_LOGIN % e)
+                    return json_response({'error': '%s' % e}, 401)
+                
+                with auth_phase('login_user'):
+                    remember = bool(data.get('remember'))
+                    logged_in = login_user(user, remember=remember)
+                
+                if not logged_in:
+                    return json_response({'error': FLASH_INACTIVE}, 403)
+                
+                with auth_phase('identity_changed'):
+                    identity_changed.send(
+                        app, identity=Identity(user.get_id()))
+                state.logger.debug(DEBUG_JSON_LOGIN % user)
+                return json_response({'id': user.get_id(), 
+                                      'username': user.username,
+                                      'email': user.email})
+        
+        if config[JSON_LOGOUT_URL_KEY]:
+            @blueprint.route(config[JSON_LOGOUT_URL_KEY], methods=['POST'], 
+                             endpoint='json_logout')
+            def json_logout():
+                # cross-site forms cannot send custom headers
+                if not request.headers.get('X-Requested-With'):
+                    return json_response({'error': ERROR_JSON_LOGOUT}, 403)
+                if current_user.is_authenticated():
+                    do_logout()
+                return app.response_class(status=204)
+        
         app.register_blueprint(blueprint, url_prefix=config[URL_PREFIX_KEY])
         
         
@@ -383,7 +898,10 @@ class AuthenticationProvider(object):
         
         :param form: An instance of a populated login form
         """
-        if not form.validate():
+        with auth_phase('form'):
+            valid = form.validate()
+        
+        if not valid:
             if form.username.errors:
                 raise BadCredentialsError(form.username.errors[0])
             if form.password.errors:
@@ -400,7 +918,9 @@ class AuthenticationProvider(object):
         :param password: The user's unencrypted password
         """
         try:
-            user = user_datastore.find_user(user_identifier)
+            state = _get_state()
+            with auth_phase('find_user'):
+                user = state.datastore.find_user(user_identifier)
         except AttributeError, e:
             self.auth_error("Could not find user service: %s" % e)
         except UserNotFoundError, e:
@@ -410,8 +930,18 @@ class AuthenticationProvider(object):
         except Exception, e:
             self.auth_error('Unexpected authentication error: %s' % e)
         
+        # credentials verified recently are not verified again
+        cache = state.credential_cache
+        if cache is not None and cache.check(user, password):
+            return user
+        
         # compare passwords
-        if pwd_context.verify(password, user.password):
+        with auth_phase('verify'):
+            verified = state.pwd_context.verify(password, user.password)
+        
+        if verified:
+            if cache is not None:
+                cache.add(user, password)
             return user
 
         # bad match
@@ -424,11 +954,64 @@ class AuthenticationProvider(object):
         logger.error(msg)
         raise AuthenticationError(msg)
 
+
+class ApiKeyAuthenticationProvider(AuthenticationProvider):
+    """An authentication provider that authenticates users with an API key 
+    instead of their password. Keys are issued with 
+    :meth:`~flask_security.datastore.UserDatastore.issue_api_key` and the 
+    key is sent in place of the password, e.g. as the password of HTTP Basic 
+    authentication. A key is looked up by its digest with a single indexed 
+    query and no password hash is verified. Example configuration::
+    
+        app.config['SECURITY_AUTH_PROVIDER'] = (
+            'flask.ext.security.ApiKeyAuthenticationProvider')
+    
+    The time each key was last used is recorded in batches by an 
+    :class:`~flask_security.tracking.ApiKeyTracker`.
+    
+    :param login_form_class: The login form class to use when authenticating a
+                             user
+    """
+    
+    def do_authenticate(self, user_identifier, password):
+        """Returns the user the API key was issued to if the identifier is the
+        user's username or email address. If authentication fails an 
+        appropriate error is raised
+        
+        :param user_identifier: The user's identifier, either an email address
+                                or username
+        :param password: The user's API key
+        """
+        try:
+            state = _get_state()
+            with auth_phase('find_user'):
+                user = state.datastore.find_user_by_api_key(password)
+        except UserNotFoundError, e:
+            raise BadCredentialsError("API key does not match")
+        except Exception, e:
+            self.auth_error('Unexpected authentication error: %s' % e)
+        
+        identifier = (user_identifier or '').strip().lower()
+        if identifier not in (user.username_lower, user.email_lower):
+            raise BadCredentialsError("API key does not match")
+        
+        state.api_key_tracker.record(user.get_id())
+        return user
+
 def do_flash(message, category):
-    if current_app.config[FLASH_MESSAGES_KEY]:
+    if _get_state().flash_messages:
         flash(message, category)
 
 
+def json_response(obj, status=200):
+    """Returns a compact JSON response.
+    
+    :param obj: The object to serialize
+    :param status: The response status code"""
+    return current_app.response_class(json.dumps(obj, separators=(',', ':')),
+                                      status=status, mimetype='application/json')
+
+
 def get_class_by_name(clazz):
     """Get a reference to a class by its string representation."""
     parts = clazz.split('.')
@@ -438,6 +1021,36 @@ def get_class_by_name(clazz):
         m = getattr(m, comp)            
     return m
 
+def get_cache_options(cache_class, options, app, datastore):
+    """Returns the keyword arguments of the user cache. Unless they are 
+    configured, the key prefix is specific to the application and datastore 
+    so that applications sharing a cache do not read each other's users, and
+    the file of a :class:`~flask_security.cache.SQLiteCache` is stored in the 
+    application's instance folder."""
+    from flask.ext.security.cache import SQLiteCache
+    options = dict(options)
+    if 'key_prefix' in inspect.getargspec(cache_class.__init__)[0]:
+        options.setdefault('key_prefix', '%s.%s.' % (
+            app.name, datastore.__class__.__name__))
+    if issubclass(cache_class, SQLiteCache) and not options.get('path'):
+        options['path'] = os.path.join(app.instance_path, 
+                                       'flask_security_cache.sqlite')
+    return options
+
+def get_bus_options(bus_class, options, app):
+    """Returns the keyword arguments of the invalidation bus. Unless it is
+    configured, the file of a 
+    :class:`~flask_security.invalidation.SQLiteInvalidationBus` is stored in 
+    the application's instance folder, so that unrelated applications do not
+    share it."""
+    from flask.ext.security.invalidation import SQLiteInvalidationBus
+    options = dict(options)
+    if issubclass(bus_class, SQLiteInvalidationBus) and \
+            not options.get('path'):
+        options['path'] = os.path.join(app.instance_path, 
+                                       'flask_security_invalidation.sqlite')
+    return options
+
 def get_class_from_config(key, config):
     """Get a reference to a class by its configuration key name."""
     try:
@@ -447,13 +1060,69 @@ def get_class_from_config(key, config):
             "Could not get class '%s' for Auth setting '%s' >> %s" %  
             (config[key], key, e)) 
 
+class RedirectResolver(object):
+    """Resolves redirect targets that may be either an endpoint or a URL. 
+    Values are classified by looking them up in the application's URL map 
+    instead of by trying to build them, and the URLs of the configured 
+    targets, such as `SECURITY_POST_LOGIN`, are built once per script root and 
+    reused.
+    
+    :param app: The application
+    """
+    
+    def __init__(self, app):
+        self.app = app
+        self._urls = {}
+    
+    def _endpoint(self, value):
+        # relative endpoints are resolved the way url_for resolves them
+        if value[:1] == '.':
+            blueprint = request.blueprint
+            return blueprint + value if blueprint is not None else value[1:]
+        return value
+    
+    def is_endpoint(self, value):
+        """Returns `True` if the value is an endpoint that a URL can be built 
+        for without arguments.
+        
+        :param value: An endpoint or a URL
+        """
+        if not value or value not in self.app.view_functions:
+            return False
+        return any(rule.arguments.issubset(rule.defaults or ()) 
+                   for rule in self.app.url_map.iter_rules(value))
+    
+    def resolve(self, value):
+        """Returns the URL of an endpoint, or the value itself if it is not 
+        an endpoint.
+        
+        :param value: An endpoint or a URL
+        """
+        if not value:
+            return value
+        endpoint = self._endpoint(value)
+        return url_for(endpoint) if self.is_endpoint(endpoint) else value
+    
+    def config_url(self, key):
+        """Returns the resolved URL of a configuration value. The URL is 
+        cached per script root, and per blueprint for relative endpoints.
+        
+        :param key: The configuration key, e.g. `SECURITY_POST_LOGIN`
+        """
+        value = self.app.config[key]
+        cache_key = (request.script_root, key, value)
+        if value and value[:1] == '.':
+            cache_key += (request.blueprint,)
+        url = self._urls.get(cache_key)
+        if url is None:
+            url = self._urls[cache_key] = self.resolve(value)
+        return url
+
+
 def get_url(endpoint_or_url):
     """Returns a URL if a valid endpoint is found. Otherwise, returns the 
     provided value."""
-    try: 
-        return url_for(endpoint_or_url)
-    except: 
-        return endpoint_or_url
+    return _get_state().redirect_resolver.resolve(endpoint_or_url)
 
 def get_post_login_redirect():
     """Returns the URL to redirect to after a user logs in successfully"""
@@ -463,11 +1132,5 @@ def get_post_login_redirect():
 
 def find_redirect(key):
     """Returns the URL to redirect to after a user logs in successfully"""
-    result = (get_url(session.pop(key.lower(), None)) or 
-              get_url(current_app.config[key.upper()] or None) or '/')
-    
-    try: 
-        del session[key.lower()]
-    except: 
-        pass
-    return result
+    return (get_url(session.pop(key.lower(), None)) or 
+            _get_state().redirect_resolver.config_url(key.upper()) or '/')
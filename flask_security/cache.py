@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.cache
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains cache implementations for use with the
+    `SECURITY_USER_CACHE` configuration value. Any cache implementing the
+    :class:`werkzeug.contrib.cache.BaseCache` interface can be used. It also
+    contains the cache of verified credentials used when the
+    `SECURITY_CREDENTIAL_CACHE_TTL` configuration value is set.
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import errno
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import threading
+
+from time import time
+
+from werkzeug.contrib.cache import BaseCache
+
+
+def _chunks(items, size=500):
+    # stay below SQLite's limit on the number of query parameters
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def _params(items):
+    return ','.join('?' * len(items))
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'), default=unicode)
+
+def _loads(value):
+    # values that are not JSON, e.g. written by an older version, are misses
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def create_private_file(path):
+    """Creates a file, and its directory if it does not exist, readable by
+    its owner only unless it already exists.
+
+    :param path: The path to the file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0600))
+
+
+class SQLiteCache(BaseCache):
+    """A cache stored in a SQLite database file. The cache is shared by every
+    process on the host that uses the same file, such as the pre-forked
+    workers of a gunicorn or uWSGI server, so a user loaded by one worker is
+    served from the cache by all of them. Example configuration::
+
+        app.config['SECURITY_USER_CACHE'] = 'flask.ext.security.cache.SQLiteCache'
+        app.config['SECURITY_USER_CACHE_OPTIONS'] = {
+            'path': '/var/run/myapp/user_cache.sqlite',
+            'default_timeout': 600
+        }
+
+    When the cache is configured with `SECURITY_USER_CACHE` and no path is
+    specified, the file is stored in the application's instance folder.
+    Values are stored as JSON, never pickled, so a process that can write the
+    file cannot make the application run code. The file is created readable
+    by its owner only, as is its directory if it does not exist.
+
+    :param path: The path to the cache database file
+    :param default_timeout: The default timeout in seconds
+    :param key_prefix: A prefix added to all keys so that several applications
+                       can share one file
+    :param threshold: The number of entries after which expired entries are
+                      pruned
+    """
+
+    def __init__(self, path, default_timeout=300, key_prefix='',
+                 threshold=10000):
+        BaseCache.__init__(self, default_timeout)
+        if not path:
+            raise ValueError('SQLiteCache requires the path of its file')
+        self.path = path
+        self.key_prefix = key_prefix
+        self.threshold = threshold
+        self._local = threading.local()
+        self._writes = 0
+        create_private_file(self.path)
+        self._execute('CREATE TABLE IF NOT EXISTS cache ('
+                      'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _connection(self):
+        # connections must not be shared across threads or forked processes
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = conn, pid
+        return self._local.connection
+
+    def _execute(self, sql, *args):
+        return self._connection().execute(sql, args)
+
+    def _prune(self):
+        self._writes += 1
+        if self._writes % 100 == 0:
+            count = self._execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+            if count > self.threshold:
+                self._execute('DELETE FROM cache WHERE expires <= ?', time())
+
+    def _expires(self, timeout):
+        return time() + (timeout or self.default_timeout)
+
+    def get(self, key):
+        row = self._execute('SELECT value FROM cache WHERE key = ? AND '
+                            'expires > ?', self.key_prefix + key,
+                            time()).fetchone()
+        if row is not None:
+            return _loads(row[0])
+
+    def get_many(self, *keys):
+        found = {}
+        prefixed = [self.key_prefix + key for key in keys]
+        for chunk in _chunks(prefixed):
+            rows = self._execute('SELECT key, value FROM cache WHERE key IN '
+                                 '(%s) AND expires > ?' % _params(chunk),
+                                 *(chunk + [time()])).fetchall()
+            found.update((k, _loads(v)) for k, v in rows)
+        return [found.get(key) for key in prefixed]
+
+    def set(self, key, value, timeout=None):
+        self._prune()
+        self._execute('INSERT OR REPLACE INTO cache (key, value, expires) '
+                      'VALUES (?, ?, ?)', self.key_prefix + key,
+                      _dumps(value), self._expires(timeout))
+
+    def add(self, key, value, timeout=None):
+        self._execute('DELETE FROM cache WHERE key = ? AND expires <= ?',
+                      self.key_prefix + key, time())
+        self._execute('INSERT OR IGNORE INTO cache (key, value, expires) '
+                      'VALUES (?, ?, ?)', self.key_prefix + key,
+                      _dumps(value), self._expires(timeout))
+
+    def delete(self, key):
+        self._execute('DELETE FROM cache WHERE key = ?', self.key_prefix + key)
+
+    def delete_many(self, *keys):
+        for chunk in _chunks([self.key_prefix + key for key in keys]):
+            self._execute('DELETE FROM cache WHERE key IN (%s)' %
+                          _params(chunk), *chunk)
+
+    def clear(self):
+        if self.key_prefix:
+            self._execute("DELETE FROM cache WHERE substr(key, 1, ?) = ?",
+                          len(self.key_prefix), self.key_prefix)
+        else:
+            self._execute('DELETE FROM cache')
+
+
+class CredentialCache(object):
+    """An in-process cache of recently verified credentials, so that clients
+    that send their credentials with every request, such as HTTP Basic
+    clients, are not verified against the slow password hash every time.
+
+    Entries are keyed by an HMAC of the user's ID and the password with a
+    random key generated for the process, so neither the password nor a
+    reusable digest of it is stored. An entry is only used while the user's
+    password hash and active state are the ones it was verified with, so
+    changing the password or deactivating the user invalidates it.
+
+    :param ttl: The number of seconds a verification is reused
+    :param max_size: The number of entries after which expired entries are
+                     pruned
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._key = os.urandom(32)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _digest(self, *values):
+        message = '\0'.join(unicode(v).encode('utf-8') for v in values)
+        return hmac.new(self._key, message, hashlib.sha256).digest()
+
+    def check(self, user, password):
+        """Returns `True` if the password was verified for the user within the
+        TTL and the user's password hash and active state are unchanged.
+
+        :param user: A `User` instance
+        :param password: The unencrypted password
+        """
+        entry = self._entries.get(self._digest(user.get_id(), password))
+        if entry is None:
+            return False
+        id, fingerprint, expires = entry
+        return (expires > time() and
+                fingerprint == self._digest(user.password, user.active))
+
+    def add(self, user, password):
+        """Records that the password was verified for the user.
+
+        :param user: A `User` instance
+        :param password: The unencrypted password
+        """
+        if len(self._entries) >= self.max_size:
+            self._prune()
+        self._entries[self._digest(user.get_id(), password)] = (
+            user.get_id(), self._digest(user.password, user.active),
+            time() + self.ttl)
+
+    def discard_user(self, id):
+        """Removes the entries of a user.
+
+        :param id: The user's ID, as returned by its `get_id` method
+        """
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry[0] == id:
+                    self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries"""
+        self._entries.clear()
+
+    def _prune(self):
+        with self._lock:
+            now = time()
+            for key, entry in self._entries.items():
+                if entry[2] <= now:
+                    self._entries.pop(key, None)
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
@@ -9,23 +9,133 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import base64
+import hashlib
+import json
+import operator
+import os
+
 from datetime import datetime
+from time import time
 from flask.ext import security
-from flask.ext.security import UserCreationError, RoleCreationError, pwd_context
+from flask.ext.security import (UserCreationError, RoleCreationError, 
+    UserDatastoreError, UserSnapshot, pwd_context)
+
+#: The number of role bits available in a user's role mask
+ROLE_BITS = 63
+
+def user_cache_key(id):
+    """Returns the cache key of the snapshot of the user with the specified ID.
+    
+    :param id: User ID
+    """
+    return 'flask_security.user.%s' % id
+
+def generate_api_key():
+    """Returns a new random API key"""
+    return base64.urlsafe_b64encode(os.urandom(30))
+
+def api_key_digest(key):
+    """Returns the SHA-256 digest an API key is stored as. API keys are random
+    so a fast digest is sufficient, unlike passwords.
+    
+    :param key: An API key
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).hexdigest()
+
+def compute_role_closure(hierarchy):
+    """Returns a dictionary mapping each role name in the specified hierarchy to
+    the set of the names of the role itself and every role it implies, 
+    directly or transitively.
+    
+    :param hierarchy: A dictionary mapping role names to the names of the roles
+                      they directly imply
+    """
+    closure = {}
+    for name in hierarchy:
+        seen, stack = set([name]), [name]
+        while stack:
+            for implied in hierarchy.get(stack.pop(), ()):
+                if implied not in seen:
+                    seen.add(implied)
+                    stack.append(implied)
+        closure[name] = frozenset(seen)
+    return closure
+
+def normalize_identifier(value):
+    """Returns the normalized form of a username or email address used for
+    case-insensitive lookups.
+    
+    :param value: A username or email address
+    """
+    if value is None:
+        return None
+    return value.strip().lower()
+
+def prefix_range(prefix):
+    """Returns the bounds `(low, high)` of the range of strings that start 
+    with a prefix, so that prefix searches can use an index.
+    
+    :param prefix: A non-empty prefix
+    """
+    prefix = unicode(prefix)
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+def _encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value, default=unicode))
+
+def _decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        raise UserDatastoreError("Invalid cursor '%s'" % cursor)
 
 class UserDatastore(object):
     """Abstracted user datastore. Always extend this class and implement the 
     :attr:`get_models`, :attr:`_save_model`, :attr:`_do_with_id`, 
     :attr:`_do_find_user`,  and :attr:`_do_find_role` methods.
     
+    The `User` and `Role` models of the datastore are available as its 
+    :attr:`User` and :attr:`Role` attributes once it has been initialized by
+    :class:`~flask_security.Security`, so that several applications with 
+    their own datastores can share a process.
+    
     :param db: An instance of a configured databse manager from a Flask 
                extension such as Flask-SQLAlchemy or Flask-MongoEngine
     :param user_account_mixin: An optional mixin class that specifies additional
                                fields to be added to the user model
     """
+    
+    #: The user fields loaded by :meth:`load_user` on every request. Only the
+    #: fields needed to establish the identity of the current user. Can be
+    #: changed with the `SECURITY_SESSION_LOAD_FIELDS` configuration value.
+    session_load_fields = ('username', 'email', 'active', 'roles')
+    
+    #: The minimum length of the prefixes of :meth:`search_users`. The users
+    #: matching a prefix are sorted by ID, which no index serves, so short
+    #: prefixes would sort most of the users for every page.
+    search_prefix_min_length = 2
+    
+    #: The number of seconds the role hierarchy is cached. Changes made by 
+    #: other processes take effect when it expires, or immediately with an 
+    #: invalidation bus. `None` caches it until it is modified through the 
+    #: datastore. Can be changed with the `SECURITY_ROLE_HIERARCHY_TTL` 
+    #: configuration value.
+    role_hierarchy_ttl = 60
+    
     def __init__(self, db, user_account_mixin=None):
         self.db = db
         self.user_account_mixin = user_account_mixin or object
+        self.User = self.Role = None
+        self.id_prefix = None
+        self.user_cache = None
+        self.invalidation_bus = None
+        self.role_bitmask = False
+        self._unnormalized_users = None
+        self._invalidate_role_closure()
+        self._invalidate_role_bits()
         
     def get_models(self):
         """Returns configured `User` and `Role` models for the datastore 
@@ -33,6 +143,14 @@ class UserDatastore(object):
         raise NotImplementedError(
             "User datastore does not implement get_models method")
     
+    def init_models(self):
+        """Creates the `User` and `Role` models of the datastore, once, and 
+        returns them."""
+        if self.User is None:
+            self.User, self.Role = self.get_models()
+            self.User.id_prefix = self.id_prefix
+        return self.User, self.Role
+    
     def _save_model(self, model, **kwargs):
         raise NotImplementedError(
             "User datastore does not implement _save_model method")
@@ -41,24 +159,176 @@ class UserDatastore(object):
         raise NotImplementedError(
             "User datastore does not implement _do_with_id method")
     
+    def _do_load_user(self, id):
+        return self._do_with_id(id)
+    
     def _do_find_user(self):
         raise NotImplementedError(
             "User datastore does not implement _do_find_user method")
     
+    def _do_has_unnormalized_users(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_has_unnormalized_users "
+            "method")
+    
+    def _do_find_unnormalized_user(self, user):
+        raise NotImplementedError(
+            "User datastore does not implement _do_find_unnormalized_user "
+            "method")
+    
     def _do_find_role(self):
         raise NotImplementedError(
             "User datastore does not implement _do_find_role method")
+    
+    def _do_search_users(self, prefix, roles, active, limit, after):
+        raise NotImplementedError(
+            "User datastore does not implement _do_search_users method")
+    
+    def _do_get_user_fields(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_user_fields method")
+    
+    def _do_get_recent_logins(self, limit):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_recent_logins method")
+    
+    def _do_find_user_by_api_key(self, digest):
+        raise NotImplementedError(
+            "User datastore does not implement _do_find_user_by_api_key method")
+    
+    def _do_record_api_key_uses(self, uses):
+        raise NotImplementedError(
+            "User datastore does not implement _do_record_api_key_uses method")
+    
+    def _do_record_logins(self, logins):
+        raise NotImplementedError(
+            "User datastore does not implement _do_record_logins method")
+    
+    def _do_iter_users(self, roles, chunk_size):
+        raise NotImplementedError(
+            "User datastore does not implement _do_iter_users method")
+    
+    def _do_set_active(self, active, identifiers, roles, return_ids):
+        raise NotImplementedError(
+            "User datastore does not implement _do_set_active method")
+    
+    def _do_delete_users(self, identifiers, roles, return_ids):
+        raise NotImplementedError(
+            "User datastore does not implement _do_delete_users method")
+    
+    def _do_delete_role(self, role, return_ids):
+        raise NotImplementedError(
+            "User datastore does not implement _do_delete_role method")
+    
+    def _do_get_roles(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_roles method")
+    
+    def _do_get_role_hierarchy(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_role_hierarchy method")
+    
+    def _do_get_role_bits(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_role_bits method")
+    
+    def _do_get_roles_without_bit(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_get_roles_without_bit method")
+    
+    def _do_sync_role_masks(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_sync_role_masks method")
+    
+    def _do_allocate_role_bit(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_allocate_role_bit method")
+    
+    def _invalidate_role_closure(self):
+        self._role_closure = None
+        self._role_closure_expires = None
+        self._effective_roles = {}
+        self._effective_masks = {}
+    
+    def _expire_role_closure(self):
+        # the hierarchy may have been modified by another process
+        expires = self._role_closure_expires
+        if expires is not None and time() >= expires:
+            self._invalidate_role_closure()
+    
+    def _invalidate_role_bits(self):
+        self._role_bits = None
+        self._mask_roles = {}
+        self._effective_masks = {}
+    
+    def _role_bit(self, role):
+        if role.bit is None:
+            raise UserDatastoreError("Role '%s' has no role bit, run "
+                                     "sync_role_masks first" % role.name)
+        return 1 << role.bit
+    
+    def _next_role_bit(self):
+        # bits are allocated from a sequence and never reused, other 
+        # processes may still map the bit of a deleted role to that role
+        bit = self._do_allocate_role_bit()
+        if bit >= ROLE_BITS:
+            raise RoleCreationError("No role bits left, role masks support at "
+                                    "most %s roles" % ROLE_BITS)
+        return bit
+        
+    def _save_user(self, user):
+        user = self._save_model(user)
+        self._invalidate_users(user.id)
+        return user
+    
+    def _global_id(self, id):
+        return '%s%s' % (self.id_prefix or '', id)
+    
+    def _invalidate_users(self, *ids):
+        if not ids:
+            return
+        ids = [self._global_id(id) for id in ids]
+        if self.user_cache is not None:
+            self.user_cache.delete_many(*[user_cache_key(id) for id in ids])
+        self._publish('user', ids)
+    
+    def _needs_ids(self):
+        # bulk operations only read the changed ids if they are invalidated
+        return self.user_cache is not None or self.invalidation_bus is not None
+    
+    def _publish(self, kind, keys):
+        if self.invalidation_bus is not None:
+            self.invalidation_bus.publish(kind, keys)
+    
+    def evict(self, kind, keys):
+        """Evicts the cached data of this process that depends on users or 
+        roles changed by another process. Called for the events of the 
+        configured invalidation bus.
+        
+        :param kind: `'user'` or `'role'`
+        :param keys: The IDs of the changed users or the names of the changed 
+                     roles
+        """
+        if kind == 'role':
+            self._invalidate_role_closure()
+            self._invalidate_role_bits()
+        elif kind == 'user' and self.user_cache is not None:
+            self.user_cache.delete_many(*[user_cache_key(id) for id in keys])
         
     def _do_add_role(self, user, role):
         user, role = self._prepare_role_modify_args(user, role)
         if role not in user.roles:
             user.roles.append(role)
+        if self.role_bitmask:
+            user.role_mask = (user.role_mask or 0) | self._role_bit(role)
         return user
         
     def _do_remove_role(self, user, role):
         user, role = self._prepare_role_modify_args(user, role)
         if role in user.roles:
             user.roles.remove(role)
+        if self.role_bitmask:
+            user.role_mask = (user.role_mask or 0) & ~self._role_bit(role)
         return user
     
     def _do_toggle_active(self, user, active=None):
@@ -75,11 +345,35 @@ class UserDatastore(object):
     def _do_active_user(self, user):
         return self._do_toggle_active(user, True)
     
+    def _prepare_bulk_args(self, users, roles):
+        if not users and not roles:
+            raise UserDatastoreError("Specify user identifiers and/or roles")
+        
+        identifiers = [normalize_identifier(
+                           u.username or u.email 
+                           if isinstance(u, self.User) else u) 
+                       for u in users or ()]
+        
+        roles = [self.find_role(r.name if isinstance(r, self.Role) else r) 
+                 for r in roles or ()]
+        
+        return identifiers, roles
+    
+    def _set_active(self, active, users, roles):
+        identifiers, roles = self._prepare_bulk_args(users, roles)
+        count, ids = self._do_set_active(active, identifiers, roles, 
+                                         self._needs_ids())
+        self._invalidate_users(*ids or ())
+        return count
+    
+    def _get_user(self, user):
+        return user if isinstance(user, self.User) else self.find_user(user)
+    
     def _prepare_role_modify_args(self, user, role):
-        if isinstance(user, security.User):
+        if isinstance(user, self.User):
             user = user.username or user.email
         
-        if isinstance(role, security.Role):
+        if isinstance(role, self.Role):
             role = role.name
             
         return self.find_user(user), self.find_role(role)
@@ -91,6 +385,17 @@ class UserDatastore(object):
         if kwargs['name'] is None:
             raise RoleCreationError("Missing name argument")
         
+        implied_roles = kwargs.get('implied_roles', [])
+        
+        for i, role in enumerate(implied_roles):
+            rn = role.name if isinstance(role, self.Role) else role
+            implied_roles[i] = self.find_role(rn)
+        
+        kwargs['implied_roles'] = implied_roles
+        
+        if self.role_bitmask and kwargs.get('bit') is None:
+            kwargs['bit'] = self._next_role_bit()
+        
         return kwargs
     
     def _prepare_create_user_args(self, kwargs):
@@ -103,16 +408,24 @@ class UserDatastore(object):
             
         if password is None:
             raise UserCreationError('Missing password argument')
+        
+        kwargs['username_lower'] = normalize_identifier(username)
+        kwargs['email_lower'] = normalize_identifier(email)
+        self._check_identifiers_available(username, email)
             
         roles = kwargs.get('roles', [])
         
         for i, role in enumerate(roles):
-            rn = role.name if isinstance(role, security.Role) else role
+            rn = role.name if isinstance(role, self.Role) else role
             # see if the role exists
             roles[i] = self.find_role(rn)
         
         kwargs['roles'] = roles
         
+        if self.role_bitmask:
+            kwargs['role_mask'] = reduce(operator.or_, 
+                                         map(self._role_bit, roles), 0)
+        
         now = datetime.utcnow()
         kwargs['created_at'], kwargs['modified_at'] = now, now
         
@@ -122,6 +435,14 @@ class UserDatastore(object):
             
         return kwargs
     
+    def _check_identifiers_available(self, *identifiers):
+        # the normalized fields are unique, but a username may not be another 
+        # user's email address either
+        for identifier in map(normalize_identifier, identifiers):
+            if identifier and self._do_find_user(identifier):
+                raise UserCreationError('A user with the username or email '
+                    'address %s already exists' % identifier)
+    
     def with_id(self, id):
         """Returns a user with the specified ID.
         
@@ -130,12 +451,99 @@ class UserDatastore(object):
         if user: return user
         raise security.UserIdNotFoundError()
     
+    def load_user(self, id):
+        """Returns a user with the specified ID loading only the fields listed
+        in :attr:`session_load_fields`. This is used to load the current user
+        on each request. Use :meth:`with_id` to load the complete user.
+        
+        :param id: User ID"""
+        user = self._do_load_user(id)
+        if user: return user
+        raise security.UserIdNotFoundError()
+    
+    def normalize_identifiers(self):
+        """Populates the normalized username and email fields of all existing 
+        users and returns the number of users that were updated. Run this 
+        after upgrading or when usernames or email addresses are changed 
+        outside of the datastore. Users whose identifiers only differ in case
+        violate the unique indexes of the normalized fields and must be 
+        renamed first."""
+        count = self._do_normalize_identifiers()
+        self._unnormalized_users = None
+        return count
+    
+    def _do_normalize_identifiers(self):
+        raise NotImplementedError(
+            "User datastore does not implement _do_normalize_identifiers "
+            "method")
+    
+    def _find_unnormalized_user(self, user):
+        # users created before upgrading can log in until the normalized 
+        # fields are populated, which is checked once per process
+        if self._unnormalized_users is None:
+            self._unnormalized_users = self._do_has_unnormalized_users()
+        if self._unnormalized_users:
+            return self._do_find_unnormalized_user(user)
+    
+    def load_user_snapshot(self, id):
+        """Returns a :class:`~flask_security.UserSnapshot` of the user with the
+        specified ID. The snapshot is served from the configured user cache 
+        and the user is only loaded from the database on a cache miss.
+        
+        :param id: User ID"""
+        key = user_cache_key(id)
+        data = self.user_cache.get(key)
+        if data is None:
+            data = UserSnapshot.to_dict(self.load_user(id))
+            self.user_cache.set(key, data)
+        return UserSnapshot(**data)
+    
+    def warm_cache(self, limit=1000, timeout=None):
+        """Preloads the role hierarchy, the role bits and, if a user cache is 
+        configured, the snapshots of the users that logged in most recently, 
+        so that the first requests after a deploy do not all hit the 
+        database. Users that are already cached are skipped. Returns the 
+        number of users that were cached.
+        
+        :param limit: The maximum number of users to preload
+        :param timeout: The optional number of seconds after which no more 
+                        users are loaded
+        """
+        deadline = None if timeout is None else time() + timeout
+        for name in self.get_role_closure():
+            self.get_effective_roles([name])
+        if self.role_bitmask:
+            self.get_role_bits()
+        
+        if self.user_cache is None or not limit:
+            return 0
+        
+        ids = [id for id, at in self._do_get_recent_logins(limit)]
+        keys = [user_cache_key(self._global_id(id)) for id in ids]
+        cached = self.user_cache.get_many(*keys) if keys else []
+        count = 0
+        for id, key, data in zip(ids, keys, cached):
+            if deadline is not None and time() >= deadline:
+                break
+            if data is not None:
+                continue
+            user = self._do_load_user(id)
+            if user is not None:
+                self.user_cache.set(key, UserSnapshot.to_dict(user))
+                count += 1
+        return count
+    
+    def ensure_indexes(self):
+        """Creates the indexes declared on the `User` and `Role` models if they
+        do not exist yet. The default implementation does nothing."""
+    
     def find_user(self, user):
-        """Returns a user based on the specified identifier. 
+        """Returns a user based on the specified identifier. The lookup is
+        case-insensitive.
         
         :param user: User identifier, usually a username or email address
         """
-        user = self._do_find_user(user)
+        user = self._do_find_user(normalize_identifier(user))
         if user: return user
         raise security.UserNotFoundError()
     
@@ -148,14 +556,269 @@ class UserDatastore(object):
         if role: return role
         raise security.RoleNotFoundError()
     
+    def get_role_closure(self):
+        """Returns a dictionary mapping the name of every role that implies 
+        other roles to the names of all the roles it implies, including 
+        itself. The closure is computed once and is recomputed after the 
+        role hierarchy is modified through the datastore or when 
+        :attr:`role_hierarchy_ttl` has elapsed."""
+        self._expire_role_closure()
+        if self._role_closure is None:
+            self._role_closure = compute_role_closure(
+                self._do_get_role_hierarchy())
+            if self.role_hierarchy_ttl is not None:
+                self._role_closure_expires = time() + self.role_hierarchy_ttl
+        return self._role_closure
+    
+    def get_effective_roles(self, roles):
+        """Returns the names of the specified roles and of all the roles they 
+        imply.
+        
+        :param roles: An iterable of role names
+        """
+        roles = frozenset(roles)
+        self._expire_role_closure()
+        effective = self._effective_roles
+        if roles not in effective:
+            closure = self.get_role_closure()
+            if len(effective) > 1000:
+                effective.clear()
+            effective[roles] = roles.union(
+                *[closure[name] for name in roles if name in closure])
+        return effective[roles]
+    
+    def get_role_bits(self):
+        """Returns a dictionary mapping role names to the bit that encodes the
+        role in a user's role mask."""
+        if self._role_bits is None:
+            self._role_bits = dict((name, 1 << bit) for name, bit in 
+                                   self._do_get_role_bits().items())
+        return self._role_bits
+    
+    def get_role_names(self, role_mask):
+        """Returns the names of the roles encoded in a role mask.
+        
+        :param role_mask: A user's role mask
+        """
+        names = self._mask_roles.get(role_mask)
+        if names is None:
+            bits = self.get_role_bits()
+            if role_mask & ~reduce(operator.or_, bits.values(), 0):
+                # a role was created by another process
+                self._invalidate_role_bits()
+                bits = self.get_role_bits()
+            if len(self._mask_roles) > 1000:
+                self._mask_roles.clear()
+            names = frozenset([n for n, bit in bits.items() if role_mask & bit])
+            self._mask_roles[role_mask] = names
+        return names
+    
+    def mask_has_role(self, role_mask, role):
+        """Returns `True` if a role mask encodes the specified role, either 
+        directly or through a role implied by one of its roles.
+        
+        :param role_mask: A user's role mask
+        :param role: A role name
+        """
+        self._expire_role_closure()
+        effective = self._effective_masks.get(role_mask)
+        if effective is None:
+            roles = self.get_effective_roles(self.get_role_names(role_mask))
+            bits = self.get_role_bits()
+            # implied roles without a bit cannot be encoded in a mask
+            effective = reduce(operator.or_, 
+                               [bits.get(n, 0) for n in roles], 0)
+            if len(self._effective_masks) > 1000:
+                self._effective_masks.clear()
+            self._effective_masks[role_mask] = effective
+        return bool(effective & self.get_role_bits().get(role, 0))
+    
+    def sync_role_masks(self):
+        """Assigns a role bit to every role that has none and recomputes the 
+        role mask of every user from its roles. Run this when enabling 
+        `SECURITY_ROLE_BITMASK` or after modifying roles outside of the 
+        datastore. Role bits are allocated from a sequence and the bits of 
+        deleted roles are never reused. Returns the number of users that were
+        updated."""
+        for role in self._do_get_roles_without_bit():
+            role.bit = self._next_role_bit()
+            self._save_model(role)
+        self._invalidate_role_bits()
+        count = self._do_sync_role_masks()
+        self._publish('role', self.get_role_bits().keys())
+        return count
+    
+    def record_logins(self, logins):
+        """Updates the login bookkeeping fields of many users at once.
+        
+        :param logins: A dictionary mapping user IDs to a tuple of the last 
+                       login time, the last login IP address and the number of
+                       logins to add to the user's login count
+        """
+        if logins:
+            self._do_record_logins(logins)
+    
+    def find_user_by_api_key(self, key):
+        """Returns the user the specified API key was issued to. The key is 
+        looked up by its digest.
+        
+        :param key: An API key
+        """
+        if key:
+            user = self._do_find_user_by_api_key(api_key_digest(key))
+            if user: return user
+        raise security.UserNotFoundError()
+    
+    def issue_api_key(self, user):
+        """Issues a new API key to a user and returns it. The key replaces the 
+        user's current key, if any. Only the digest of the key is stored, so 
+        the returned key cannot be retrieved later.
+        
+        :param user: A User instance or a user identifier
+        """
+        user = self._get_user(user)
+        key = generate_api_key()
+        user.api_key_digest = api_key_digest(key)
+        user.api_key_last_used_at = None
+        self._save_user(user)
+        return key
+    
+    def rotate_api_key(self, user):
+        """Replaces the API key of a user that has one with a new key and 
+        returns the new key.
+        
+        :param user: A User instance or a user identifier
+        """
+        user = self._get_user(user)
+        if user.api_key_digest is None:
+            raise UserDatastoreError("User '%s' has no API key" % user)
+        return self.issue_api_key(user)
+    
+    def revoke_api_key(self, user):
+        """Revokes the API key of a user and returns the modified user.
+        
+        :param user: A User instance or a user identifier
+        """
+        user = self._get_user(user)
+        user.api_key_digest = None
+        return self._save_user(user)
+    
+    def record_api_key_uses(self, uses):
+        """Updates the time the API keys of many users were last used at 
+        once.
+        
+        :param uses: A dictionary mapping user IDs to the time their API key 
+                     was last used
+        """
+        if uses:
+            self._do_record_api_key_uses(uses)
+    
+    def iter_users(self, roles=None, chunk_size=1000):
+        """Yields a dictionary with the `id`, `username`, `email`, `active`,
+        `created_at` and `roles` (role names) of each user, ordered by ID. 
+        Users are read from the database in chunks so that memory use does not
+        depend on the number of users.
+        
+        :param roles: Optional role names. Only users with at least one of the
+                      roles are included
+        :param chunk_size: The number of users read from the database at once
+        """
+        if roles:
+            roles = [self.find_role(r.name if isinstance(r, self.Role) 
+                                    else r) for r in roles]
+        return self._do_iter_users(roles, chunk_size)
+    
+    def search_users(self, query=None, roles=None, active=None, limit=50,
+                     cursor=None):
+        """Returns a page of the users matching a search, ordered by ID, as a 
+        tuple of a list of dictionaries with the same keys as 
+        :meth:`iter_users` and the cursor of the next page, or `None` on the 
+        last page. Pages are read with a keyset on the ID. Without a query 
+        the last page is read as fast as the first. With a query the users 
+        matching the prefix are found with the indexes of the normalized 
+        fields and then sorted by ID, so every page costs in proportion to 
+        the number of matching users. Prefixes must therefore have at least
+        :attr:`search_prefix_min_length` characters. Example::
+        
+            users, cursor = user_datastore.search_users('ma', roles=['admin'])
+            while cursor is not None:
+                users, cursor = user_datastore.search_users(
+                    'ma', roles=['admin'], cursor=cursor)
+        
+        :param query: Optional prefix of the usernames or email addresses of 
+                      the users. The search is case-insensitive
+        :param roles: Optional role names. Only users with at least one of the
+                      roles are included
+        :param active: Optional active state of the users
+        :param limit: The number of users per page
+        :param cursor: The cursor returned with the previous page. The other 
+                       arguments must be the same as for the previous page
+        """
+        if roles:
+            roles = [self.find_role(r.name if isinstance(r, self.Role) 
+                                    else r) for r in roles]
+        after = None if cursor is None else _decode_cursor(cursor)
+        prefix = normalize_identifier(query) or None
+        if prefix is not None and len(prefix) < self.search_prefix_min_length:
+            raise UserDatastoreError("Search prefixes must have at least %s "
+                "characters" % self.search_prefix_min_length)
+        users = self._do_search_users(prefix, roles, active, limit + 1, after)
+        if len(users) <= limit:
+            return users, None
+        users = users[:limit]
+        return users, _encode_cursor(users[-1]['id'])
+    
     def create_role(self, **kwargs):
         """Creates and returns a new role.
         
         :param name: Role name
         :param description: Role description
+        :param implied_roles: The optional roles implied by the new role
+        """
+        role = self.Role(**self._prepare_create_role_args(kwargs))
+        role = self._save_model(role)
+        if role.implied_roles:
+            self._invalidate_role_closure()
+        if self.role_bitmask:
+            self._invalidate_role_bits()
+        self._publish('role', [role.name])
+        return role
+    
+    def add_implied_role(self, role, implied_role):
+        """Makes a role imply another role. Users with the role are then 
+        considered to have the implied role and all the roles it implies as 
+        well. Returns the modified role.
+        
+        :param role: A Role instance or a role name
+        :param implied_role: A Role instance or a role name
+        """
+        role, implied_role = self._prepare_implied_role_args(role, implied_role)
+        if implied_role not in role.implied_roles:
+            role.implied_roles.append(implied_role)
+        return self._save_role_hierarchy(role)
+    
+    def remove_implied_role(self, role, implied_role):
+        """Makes a role no longer imply another role. Returns the modified 
+        role.
+        
+        :param role: A Role instance or a role name
+        :param implied_role: A Role instance or a role name
         """
-        role = security.Role(**self._prepare_create_role_args(kwargs))
-        return self._save_model(role)
+        role, implied_role = self._prepare_implied_role_args(role, implied_role)
+        if implied_role in role.implied_roles:
+            role.implied_roles.remove(implied_role)
+        return self._save_role_hierarchy(role)
+    
+    def _prepare_implied_role_args(self, role, implied_role):
+        names = [r.name if isinstance(r, self.Role) else r 
+                 for r in (role, implied_role)]
+        return [self.find_role(name) for name in names]
+    
+    def _save_role_hierarchy(self, role):
+        role = self._save_model(role)
+        self._invalidate_role_closure()
+        self._publish('role', [role.name])
+        return role
     
     def create_user(self, **kwargs):
         """Creates and returns a new user.
@@ -165,8 +828,8 @@ class UserDatastore(object):
         :param password: Unencrypted password
         :param active: The optional active state
         """
-        user = security.User(**self._prepare_create_user_args(kwargs))
-        return self._save_model(user)
+        user = self.User(**self._prepare_create_user_args(kwargs))
+        return self._save_user(user)
     
     def add_role_to_user(self, user, role):
         """Adds a role to a user if the user does not have it already. Returns 
@@ -175,7 +838,7 @@ class UserDatastore(object):
         :param user: A User instance or a user identifier
         :param role: A Role instance or a role name
         """
-        return self._save_model(self._do_add_role(user, role))
+        return self._save_user(self._do_add_role(user, role))
     
     def remove_role_from_user(self, user, role, commit=True):
         """Removes a role from a user if the user has the role. Returns the 
@@ -184,18 +847,81 @@ class UserDatastore(object):
         :param user: A User instance or a user identifier
         :param role: A Role instance or a role name
         """
-        return self._save_model(self._do_remove_role(user, role))
+        return self._save_user(self._do_remove_role(user, role))
     
     def deactivate_user(self, user):
         """Deactivates a user and returns the modified user.
         
         :param user: A User instance or a user identifier
         """
-        return self._save_model(self._do_deactive_user(user))
+        return self._save_user(self._do_deactive_user(user))
     
     def activate_user(self, user, commit=True):
         """Activates a user and returns the modified user.
         
         :param user: A User instance or a user identifier
         """
-        return self._save_model(self._do_active_user(user))
\ No newline at end of file
+        return self._save_user(self._do_active_user(user))
+    
+    def activate_users(self, users=None, roles=None):
+        """Activates many users at once with a single update, without loading 
+        them, and returns the number of users that were activated. Users 
+        matching any of the arguments are activated.
+        
+        :param users: Optional User instances or user identifiers
+        :param roles: Optional Role instances or role names. Users with at
+                      least one of the roles are activated
+        """
+        return self._set_active(True, users, roles)
+    
+    def deactivate_users(self, users=None, roles=None):
+        """Deactivates many users at once with a single update, without 
+        loading them, and returns the number of users that were deactivated. 
+        Users matching any of the arguments are deactivated.
+        
+        :param users: Optional User instances or user identifiers
+        :param roles: Optional Role instances or role names. Users with at
+                      least one of the roles are deactivated
+        """
+        return self._set_active(False, users, roles)
+    
+    def delete_users(self, users=None, roles=None):
+        """Deletes many users at once with set-based deletes, without loading 
+        them, and returns the number of users that were deleted. Users 
+        matching any of the arguments are deleted.
+        
+        :param users: Optional User instances or user identifiers
+        :param roles: Optional Role instances or role names. Users with at
+                      least one of the roles are deleted
+        """
+        identifiers, roles = self._prepare_bulk_args(users, roles)
+        count, ids = self._do_delete_users(identifiers, roles, 
+                                           self._needs_ids())
+        self._invalidate_users(*ids or ())
+        return count
+    
+    def delete_user(self, user):
+        """Deletes a user.
+        
+        :param user: A User instance or a user identifier
+        """
+        if not self.delete_users(users=[user]):
+            raise security.UserNotFoundError()
+    
+    def delete_role(self, role):
+        """Deletes a role, removes it from every user that has it and from the
+        roles that imply it. Returns the number of users the role was removed
+        from. The role's bit is cleared from the role masks of its users,
+        :meth:`sync_role_masks` recomputes the masks from the roles.
+        
+        :param role: A Role instance or a role name
+        """
+        role = self.find_role(role.name if isinstance(role, self.Role) 
+                              else role)
+        name = role.name
+        count, ids = self._do_delete_role(role, self._needs_ids())
+        self._invalidate_role_closure()
+        self._invalidate_role_bits()
+        self._publish('role', [name])
+        self._invalidate_users(*ids or ())
+        return count
@@ -9,9 +9,23 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from flask.ext import security
-from flask.ext.security import UserMixin, RoleMixin
-from flask.ext.security.datastore import UserDatastore
+from __future__ import absolute_import
+
+import itertools
+import operator
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from mongoengine.queryset import OperationError, Q
+from flask.ext.security import UserMixin, RoleMixin, UserDatastoreError
+from flask.ext.security.datastore import (UserDatastore, normalize_identifier,
+    prefix_range)
+
+def _user_indexes():
+    # new specs on every call, mongoengine rewrites the specs it builds
+    return [{'fields': ['username_lower'], 'unique': True, 'sparse': True},
+            {'fields': ['email_lower'], 'unique': True, 'sparse': True},
+            '-last_login_at', 'api_key_digest']
     
 class MongoEngineUserDatastore(UserDatastore):
     """A MongoEngine datastore implementation for Flask-Security. 
@@ -40,18 +54,40 @@ class MongoEngineUserDatastore(UserDatastore):
             
             name = db.StringField(required=True, unique=True, max_length=80)
             description = db.StringField(max_length=255)
+            implied_roles = db.ListField(db.ReferenceField('self'), default=[])
+            bit = db.IntField()
               
         class User(db.Document, UserMixin, self.user_account_mixin):
             """MongoEngine User model"""
             
             username = db.StringField(unique=True, max_length=255)
             email = db.StringField(unique=True, max_length=255)
+            username_lower = db.StringField(max_length=255)
+            email_lower = db.StringField(max_length=255)
             password = db.StringField(required=True, max_length=120)
             active = db.BooleanField(default=True)
+            role_mask = db.IntField(default=0)
             roles= db.ListField(db.ReferenceField(Role), default=[])
             created_at = db.DateTimeField()
             modified_at = db.DateTimeField()
+            last_login_at = db.DateTimeField()
+            last_login_ip = db.StringField(max_length=45)
+            login_count = db.IntField(default=0)
+            api_key_digest = db.StringField(max_length=64)
+            api_key_last_used_at = db.DateTimeField()
+            
+            meta = {
+                'indexes': _user_indexes(),
+                'auto_create_index': False
+            }
+        
+        class RoleBitSequence(db.Document):
+            """The next role bit to allocate"""
+            
+            id = db.StringField(primary_key=True)
+            next_bit = db.IntField(required=True)
             
+        self.RoleBitSequence = RoleBitSequence
         return User, Role
     
     def _save_model(self, model):
@@ -59,13 +95,211 @@ class MongoEngineUserDatastore(UserDatastore):
         return model
         
     def _do_with_id(self, id):
-        try: return security.User.objects.get(id=id)
+        try: return self.User.objects.get(id=id)
         except: return None
     
+    def _do_load_user(self, id):
+        try: 
+            return self.User.objects.only(
+                *self.session_load_fields).get(id=id)
+        except: 
+            return None
+    
+    def _do_normalize_identifiers(self):
+        count = 0
+        for user in self.User.objects.only('username', 'email').order_by('id'):
+            self.User.objects(id=user.id).update_one(
+                set__username_lower=normalize_identifier(user.username),
+                set__email_lower=normalize_identifier(user.email))
+            count += 1
+        return count
+    
+    def ensure_indexes(self):
+        # the indexes are not created automatically, the unique fields and
+        # the declared specs are passed to the public QuerySet.ensure_index
+        for model, indexes in ((self.User, _user_indexes()), (self.Role, [])):
+            for name, field in model._fields.items():
+                if field.unique and not field.primary_key:
+                    model.objects.ensure_index(
+                        {'fields': [name], 'unique': True, 'types': False})
+            for spec in indexes:
+                model.objects.ensure_index(spec)
+    
     def _do_find_user(self, user):
-        return security.User.objects(username=user).first() or \
-               security.User.objects(email=user).first()
+        return self.User.objects(username_lower=user).first() or \
+               self.User.objects(email_lower=user).first() or \
+               self._find_unnormalized_user(user)
+    
+    def _do_has_unnormalized_users(self):
+        return self.User.objects(Q(username_lower=None, username__ne=None) | 
+                                 Q(email_lower=None, email__ne=None)) \
+            .only('id').first() is not None
+    
+    def _do_find_unnormalized_user(self, user):
+        return self.User.objects(
+            Q(username_lower=None, username__iexact=user) |
+            Q(email_lower=None, email__iexact=user)).first()
     
     def _do_find_role(self, role):
-        return security.Role.objects(name=role).first()
+        return self.Role.objects(name=role).first()
+    
+    def _do_get_role_bits(self):
+        roles = self.Role.objects(bit__ne=None).only('name', 'bit')
+        return dict((role.name, role.bit) for role in roles)
+    
+    def _do_get_roles(self):
+        return list(self.Role.objects.order_by('id'))
+    
+    def _do_get_roles_without_bit(self):
+        return list(self.Role.objects(bit=None).order_by('id'))
+    
+    def _do_sync_role_masks(self, chunk_size=1000):
+        # the role references are read without dereferencing them, and the
+        # users of a chunk with the same mask are updated at once
+        bits = dict((role.id, role.bit) for role in 
+                    self.Role.objects(bit__ne=None).only('bit'))
+        collection = self.User._get_collection()
+        cursor = collection.find({}, fields=['roles'])
+        count = 0
+        while True:
+            chunk = list(itertools.islice(cursor, chunk_size))
+            if not chunk:
+                return count
+            masks = {}
+            for user in chunk:
+                mask = 0
+                for ref in user.get('roles', ()):
+                    if bits.get(ref.id) is not None:
+                        mask |= 1 << bits[ref.id]
+                masks.setdefault(mask, []).append(user['_id'])
+            for mask, ids in masks.items():
+                collection.update({'_id': {'$in': ids}}, 
+                                  {'$set': {'role_mask': mask}}, multi=True)
+            count += len(chunk)
+    
+    def _do_allocate_role_bit(self):
+        Sequence = self.RoleBitSequence
+        while True:
+            sequence = Sequence.objects(id='role_bit').first()
+            if sequence is None:
+                # the bits assigned before the sequence existed are skipped
+                bits = self._do_get_role_bits().values()
+                try:
+                    Sequence(id='role_bit', next_bit=max(bits + [-1]) + 1) \
+                        .save(force_insert=True)
+                except OperationError:
+                    pass
+                continue
+            # compare and set, another process may have taken the bit
+            if Sequence.objects(id='role_bit', next_bit=sequence.next_bit) \
+                    .update_one(inc__next_bit=1):
+                return sequence.next_bit
+    
+    def _do_get_user_fields(self):
+        return [name for name in self.User._fields 
+                if name not in ('id', 'roles')]
+    
+    def _do_get_recent_logins(self, limit):
+        users = self.User.objects(last_login_at__ne=None) \
+            .order_by('-last_login_at').only('last_login_at').limit(limit)
+        return [(user.id, user.last_login_at) for user in users]
+    
+    def _do_find_user_by_api_key(self, digest):
+        return self.User.objects(api_key_digest=digest).first()
+    
+    def _do_record_api_key_uses(self, uses):
+        for id, at in uses.items():
+            self.User.objects(id=id).update_one(set__api_key_last_used_at=at)
+    
+    def _do_record_logins(self, logins):
+        for id, (at, ip, count) in logins.items():
+            self.User.objects(id=id).update_one(set__last_login_at=at, 
+                set__last_login_ip=ip, inc__login_count=count)
+    
+    def _do_iter_users(self, roles, chunk_size):
+        query = self.User.objects(roles__in=roles) if roles \
+                else self.User.objects
+        query = query.only('username', 'email', 'active', 'created_at', 
+                           'roles').order_by('id')
+        last_id = None
+        while True:
+            chunk = query.clone()
+            if last_id is not None:
+                chunk = chunk.filter(id__gt=last_id)
+            users = chunk.limit(chunk_size).select_related()
+            for user in users:
+                yield self._export_user(user)
+            if len(users) < chunk_size:
+                return
+            last_id = users[-1].id
+    
+    def _export_user(self, user):
+        return dict(id=user.id, username=user.username, email=user.email, 
+                    active=user.active, created_at=user.created_at, 
+                    roles=[r.name for r in user.roles])
+    
+    def _do_search_users(self, prefix, roles, active, limit, after):
+        query = self.User.objects
+        if prefix:
+            low, high = prefix_range(prefix)
+            query = query.filter(
+                Q(username_lower__gte=low, username_lower__lt=high) | 
+                Q(email_lower__gte=low, email_lower__lt=high))
+        if roles:
+            query = query.filter(roles__in=roles)
+        if active is not None:
+            query = query.filter(active=active)
+        if after is not None:
+            try:
+                query = query.filter(id__gt=ObjectId(after))
+            except (InvalidId, TypeError):
+                raise UserDatastoreError("Invalid cursor")
+        users = query.only('username', 'email', 'active', 'created_at', 
+                           'roles').order_by('id').limit(limit)
+        return [self._export_user(user) for user in users.select_related()]
+    
+    def _bulk_query(self, identifiers, roles):
+        criteria = []
+        if identifiers:
+            criteria.append(Q(username_lower__in=identifiers))
+            criteria.append(Q(email_lower__in=identifiers))
+        if roles:
+            criteria.append(Q(roles__in=roles))
+        return self.User.objects(reduce(operator.or_, criteria))
+    
+    def _do_set_active(self, active, identifiers, roles, return_ids):
+        query = self._bulk_query(identifiers, roles).filter(active__ne=active)
+        ids = [user.id for user in query.only('id')] if return_ids else None
+        count = query.update(set__active=active)
+        return count, ids
+    
+    def _do_delete_users(self, identifiers, roles, return_ids):
+        query = self._bulk_query(identifiers, roles)
+        ids = [user.id for user in query.only('id')] if return_ids else None
+        count = query.count()
+        query.delete()
+        return count, ids
+    
+    def _do_delete_role(self, role, return_ids):
+        ids = None
+        if return_ids:
+            ids = [user.id for user in 
+                   self.User.objects(roles=role).only('id')]
+        ref = self.User._fields['roles'].field.to_mongo(role)
+        update = {'$pull': {'roles': ref}}
+        if role.bit is not None:
+            # MongoEngine has no $bit update, the bit is cleared with an and
+            # so that masks that are out of sync keep their other bits
+            update['$bit'] = {'role_mask': {'and': long(~(1 << role.bit))}}
+        count = self.User._get_collection().update(
+            {'roles': ref}, update, multi=True, safe=True)['n']
+        self.Role.objects(implied_roles=role).update(
+            pull__implied_roles=role)
+        role.delete()
+        return count, ids
+    
+    def _do_get_role_hierarchy(self):
+        roles = self.Role.objects(implied_roles__not__size=0)
+        return dict((role.name, [r.name for r in role.implied_roles]) 
+                    for role in roles)
     
\ No newline at end of file
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.datastore.sharded
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains a Flask-Security datastore that distributes users
+    across several datastores
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import hashlib
+import operator
+
+from operator import itemgetter
+
+from flask.ext.security import (RoleMixin, UserMixin, UserSnapshot, 
+    UserCreationError, UserDatastoreError)
+from flask.ext.security.datastore import UserDatastore, normalize_identifier
+
+def jump_hash(key, num_buckets):
+    """Returns the bucket of a key using the jump consistent hash of Lamping
+    and Veach. When the number of buckets grows from `n` to `n + 1` only
+    `1 / (n + 1)` of the keys move, all of them to the new bucket.
+
+    :param key: A 64 bit unsigned integer
+    :param num_buckets: The number of buckets
+    """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+def _shared(name):
+    # an attribute that is set on every shard
+    def fget(self):
+        return getattr(self.shards[0], name)
+    def fset(self, value):
+        for shard in self.shards:
+            setattr(shard, name, value)
+    return property(fget, fset)
+
+
+class ShardedUserDatastore(UserDatastore):
+    """A datastore that distributes users across several datastores, the
+    shards, by a stable hash of their normalized username, or email address if
+    they have no username. Roles are replicated to every shard. The IDs of
+    users are prefixed with the index of their shard. Example usage with
+    SQLite databases::
+
+        app.config['SQLALCHEMY_BINDS'] = {
+            'users0': 'sqlite:////var/lib/myapp/users0.sqlite',
+            'users1': 'sqlite:////var/lib/myapp/users1.sqlite'
+        }
+
+        shards = [SQLAlchemyUserDatastore(SQLAlchemy(app), bind_key=key)
+                  for key in ('users0', 'users1')]
+        Security(app, ShardedUserDatastore(shards))
+
+    Logins by username are served by the owning shard. Lookups by email
+    address of users with a username try the other shards as well. Role bits
+    are allocated by the first shard so that a role has the same bit on every
+    shard. Shards are only ever appended with :meth:`add_shard`, run
+    :meth:`rebalance` after adding one.
+
+    :param shards: The datastores of the shards
+    """
+
+    _shared_attributes = ('user_cache', 'invalidation_bus', 'role_bitmask',
+                          'session_load_fields', 'role_hierarchy_ttl')
+
+    user_cache = _shared('user_cache')
+    invalidation_bus = _shared('invalidation_bus')
+    role_bitmask = _shared('role_bitmask')
+    session_load_fields = _shared('session_load_fields')
+    role_hierarchy_ttl = _shared('role_hierarchy_ttl')
+
+    def __init__(self, shards):
+        if not shards:
+            raise UserDatastoreError("A sharded datastore needs a shard")
+        self.shards = list(shards)
+        for index, shard in enumerate(self.shards):
+            shard.id_prefix = '%s:' % index
+        super(ShardedUserDatastore, self).__init__(None)
+        self.id_prefix = None
+
+    def init_models(self):
+        for shard in self.shards:
+            shard.init_models()
+        self.User, self.Role = self.shards[0].User, self.shards[0].Role
+        return self.User, self.Role
+
+    def add_shard(self, shard):
+        """Appends a shard and returns its index. Create the shard's tables
+        or collections and then run :meth:`rebalance` to replicate the roles
+        to it and move the users it owns.
+
+        :param shard: The datastore of the new shard
+        """
+        index = len(self.shards)
+        shard.id_prefix = '%s:' % index
+        for name in self._shared_attributes:
+            setattr(shard, name, getattr(self.shards[0], name))
+        if self.User is not None:
+            shard.init_models()
+        self.shards.append(shard)
+        return index
+
+    def shard_index(self, identifier):
+        """Returns the index of the shard that owns the user with the
+        specified identifier.
+
+        :param identifier: The user's username, or email address if the user
+                           has no username
+        """
+        digest = hashlib.md5(normalize_identifier(identifier).encode('utf-8'))
+        return jump_hash(int(digest.hexdigest()[:16], 16), len(self.shards))
+
+    def _split_id(self, id):
+        index, sep, local_id = unicode(id).partition(':')
+        if sep and index.isdigit() and int(index) < len(self.shards):
+            return self.shards[int(index)], local_id
+        return None, None
+
+    def _owner(self, user):
+        if isinstance(user, UserSnapshot):
+            user = user.get_model()
+        elif not isinstance(user, UserMixin):
+            user = self.find_user(user)
+        for shard in self.shards:
+            if isinstance(user, shard.User):
+                return shard, user
+        raise UserDatastoreError("User '%s' is not stored in a shard" % user)
+
+    def _identifier(self, user):
+        if isinstance(user, (UserMixin, UserSnapshot)):
+            return user.username or user.email
+        return user
+
+    def _role_name(self, role):
+        return role.name if isinstance(role, RoleMixin) else role
+
+    def _do_with_id(self, id):
+        shard, local_id = self._split_id(id)
+        return shard._do_with_id(local_id) if shard else None
+
+    def _do_load_user(self, id):
+        shard, local_id = self._split_id(id)
+        return shard._do_load_user(local_id) if shard else None
+
+    def _do_find_user(self, user):
+        owner = self.shard_index(user)
+        for index in [owner] + [i for i in range(len(self.shards))
+                                if i != owner]:
+            found = self.shards[index]._do_find_user(user)
+            if found:
+                return found
+
+    def _do_find_role(self, role):
+        return self.shards[0]._do_find_role(role)
+
+    def evict(self, kind, keys):
+        if kind == 'role':
+            for shard in self.shards:
+                shard.evict(kind, keys)
+        else:
+            # the user cache is shared by the shards
+            self.shards[0].evict(kind, keys)
+    
+    def ensure_indexes(self):
+        for shard in self.shards:
+            shard.ensure_indexes()
+
+    def normalize_identifiers(self):
+        return sum(shard.normalize_identifiers() for shard in self.shards)
+
+    def sync_role_masks(self):
+        # the bits are assigned by the first shard and then replicated
+        primary = self.shards[0]
+        for role in primary._do_get_roles_without_bit():
+            role.bit = primary._next_role_bit()
+            primary._save_model(role)
+        self.replicate_roles()
+        return sum(shard.sync_role_masks() for shard in self.shards)
+
+    def replicate_roles(self):
+        """Copies the roles of the first shard, with their descriptions, bits
+        and implied roles, to the other shards and returns the number of 
+        roles that were created. The role masks of a shard are recomputed if
+        any of its role bits changed. Run by :meth:`rebalance`."""
+        primary = self.shards[0]
+        roles = primary._do_get_roles()
+        bits = dict((role.name, role.bit) for role in roles)
+        hierarchy = primary._do_get_role_hierarchy()
+        created = 0
+        for shard in self.shards[1:]:
+            copies = dict((role.name, role) for role in shard._do_get_roles())
+            # bits are unique, so differing bits are cleared first
+            changed = [copy for copy in copies.values() 
+                       if copy.bit is not None and 
+                       copy.bit != bits.get(copy.name)]
+            for copy in changed:
+                copy.bit = None
+                shard._save_model(copy)
+            for role in roles:
+                copy = copies.get(role.name)
+                if copy is None:
+                    copy = copies[role.name] = shard.Role(name=role.name)
+                    created += 1
+                elif (copy.description, copy.bit) == (role.description, 
+                                                      role.bit):
+                    continue
+                copy.description, copy.bit = role.description, role.bit
+                shard._save_model(copy)
+                changed.append(copy)
+            for role in roles:
+                copy = copies[role.name]
+                implied = sorted(hierarchy.get(role.name, []))
+                if sorted(r.name for r in copy.implied_roles) != implied:
+                    copy.implied_roles = [copies[name] for name in implied]
+                    shard._save_model(copy)
+            shard._invalidate_role_closure()
+            shard._invalidate_role_bits()
+            if changed:
+                shard._do_sync_role_masks()
+        self._publish('role', bits.keys())
+        return created
+
+    def get_role_closure(self):
+        return self.shards[0].get_role_closure()
+
+    def get_effective_roles(self, roles):
+        return self.shards[0].get_effective_roles(roles)
+
+    def get_role_bits(self):
+        return self.shards[0].get_role_bits()
+
+    def get_role_names(self, role_mask):
+        return self.shards[0].get_role_names(role_mask)
+
+    def mask_has_role(self, role_mask, role):
+        return self.shards[0].mask_has_role(role_mask, role)
+
+    def _do_get_recent_logins(self, limit):
+        logins = []
+        for shard in self.shards:
+            logins.extend((shard._global_id(id), at) 
+                          for id, at in shard._do_get_recent_logins(limit))
+        return sorted(logins, key=itemgetter(1), reverse=True)[:limit]
+    
+    def _by_shard(self, values):
+        by_shard = {}
+        for id, value in values.items():
+            shard, local_id = self._split_id(id)
+            if shard is not None:
+                by_shard.setdefault(shard, {})[local_id] = value
+        return by_shard.items()
+    
+    def record_logins(self, logins):
+        for shard, shard_logins in self._by_shard(logins):
+            shard.record_logins(shard_logins)
+    
+    def record_api_key_uses(self, uses):
+        for shard, shard_uses in self._by_shard(uses):
+            shard.record_api_key_uses(shard_uses)
+    
+    def _do_find_user_by_api_key(self, digest):
+        for shard in self.shards:
+            user = shard._do_find_user_by_api_key(digest)
+            if user:
+                return user
+    
+    def issue_api_key(self, user):
+        shard, user = self._owner(user)
+        return shard.issue_api_key(user)
+    
+    def rotate_api_key(self, user):
+        shard, user = self._owner(user)
+        return shard.rotate_api_key(user)
+    
+    def revoke_api_key(self, user):
+        shard, user = self._owner(user)
+        return shard.revoke_api_key(user)
+
+    def iter_users(self, roles=None, chunk_size=1000):
+        roles = [self._role_name(role) for role in roles or ()]
+        for shard in self.shards:
+            for user in shard.iter_users(roles=roles, chunk_size=chunk_size):
+                user['id'] = shard._global_id(user['id'])
+                yield user
+
+    def _do_search_users(self, prefix, roles, active, limit, after):
+        # users are ordered by shard and then by ID within their shard
+        start, local_after = 0, None
+        if after is not None:
+            shard, local_after = self._split_id(after)
+            if shard is None:
+                raise UserDatastoreError("Invalid cursor")
+            start = self.shards.index(shard)
+        users = []
+        for shard in self.shards[start:]:
+            shard_roles = [shard.find_role(role.name) for role in roles or ()]
+            for user in shard._do_search_users(prefix, shard_roles, active,
+                                               limit - len(users), 
+                                               local_after):
+                user['id'] = shard._global_id(user['id'])
+                users.append(user)
+            if len(users) >= limit:
+                break
+            local_after = None
+        return users
+    
+    def create_role(self, **kwargs):
+        implied_roles = [self._role_name(role)
+                         for role in kwargs.get('implied_roles', [])]
+        if self.role_bitmask:
+            kwargs['bit'] = self.shards[0]._next_role_bit()
+        roles = [shard.create_role(**dict(kwargs,
+                                          implied_roles=list(implied_roles)))
+                 for shard in self.shards]
+        return roles[0]
+
+    def add_implied_role(self, role, implied_role):
+        role, implied_role = map(self._role_name, (role, implied_role))
+        return [shard.add_implied_role(role, implied_role)
+                for shard in self.shards][0]
+
+    def remove_implied_role(self, role, implied_role):
+        role, implied_role = map(self._role_name, (role, implied_role))
+        return [shard.remove_implied_role(role, implied_role)
+                for shard in self.shards][0]
+
+    def delete_role(self, role):
+        role = self._role_name(role)
+        return sum(shard.delete_role(role) for shard in self.shards)
+
+    def create_user(self, **kwargs):
+        kwargs['roles'] = [self._role_name(role)
+                           for role in kwargs.get('roles', [])]
+        identifier = kwargs.get('username') or kwargs.get('email')
+        if identifier is None:
+            raise UserCreationError('Missing username and/or email arguments')
+        # the email address may be taken on another shard
+        self._check_identifiers_available(kwargs.get('username'),
+                                          kwargs.get('email'))
+        return self.shards[self.shard_index(identifier)].create_user(**kwargs)
+
+    def add_role_to_user(self, user, role):
+        shard, user = self._owner(user)
+        return shard.add_role_to_user(user, self._role_name(role))
+
+    def remove_role_from_user(self, user, role, commit=True):
+        shard, user = self._owner(user)
+        return shard.remove_role_from_user(user, self._role_name(role))
+
+    def activate_user(self, user, commit=True):
+        shard, user = self._owner(user)
+        return shard.activate_user(user)
+
+    def deactivate_user(self, user):
+        shard, user = self._owner(user)
+        return shard.deactivate_user(user)
+
+    def _bulk(self, method, users, roles):
+        users = [self._identifier(user) for user in users or ()]
+        roles = [self._role_name(role) for role in roles or ()]
+        return sum(getattr(shard, method)(users=users, roles=roles)
+                   for shard in self.shards)
+
+    def activate_users(self, users=None, roles=None):
+        return self._bulk('activate_users', users, roles)
+
+    def deactivate_users(self, users=None, roles=None):
+        return self._bulk('deactivate_users', users, roles)
+
+    def delete_users(self, users=None, roles=None):
+        return self._bulk('delete_users', users, roles)
+
+    def rebalance(self, chunk_size=1000):
+        """Replicates the roles to every shard and moves every user that is
+        not stored in the shard its identifier hashes to, such as after 
+        adding a shard, and returns the number of users that were moved. 
+        Moved users get a new ID and their sessions end.
+
+        A move is not atomic: the user is copied to its shard before it is
+        deleted from the old one. Until then :meth:`find_user` returns the
+        copy, which is stored in the shard that is tried first. If the
+        rebalance is interrupted, run it again. It reuses the copies it 
+        finds and resumes the moves.
+
+        :param chunk_size: The number of users read from a shard at once
+        """
+        self.replicate_roles()
+        moved = 0
+        for index, shard in enumerate(self.shards):
+            misplaced = []
+            for user in shard.iter_users(chunk_size=chunk_size):
+                owner = self.shard_index(user['username'] or user['email'])
+                if owner != index:
+                    misplaced.append((user['id'], self.shards[owner]))
+            for id, target in misplaced:
+                self._move_user(shard, target, id)
+            moved += len(misplaced)
+        return moved
+
+    def _move_user(self, source, target, id):
+        user = source.with_id(id)
+        identifier = normalize_identifier(user.username or user.email)
+        # the copy of an interrupted move is kept
+        if target._do_find_user(identifier) is None:
+            copy = target.User()
+            for field in source._do_get_user_fields():
+                setattr(copy, field, getattr(user, field))
+            copy.roles = [target.find_role(role.name) for role in user.roles]
+            # the mask is encoded with the target's bits
+            copy.role_mask = reduce(operator.or_, [1 << role.bit for role in 
+                                                   copy.roles 
+                                                   if role.bit is not None], 0)
+            target._save_user(copy)
+            if target._do_find_user(identifier) is None:
+                raise UserDatastoreError("User '%s' could not be copied to "
+                                         "its shard" % identifier)
+        source.delete_users(users=[user])
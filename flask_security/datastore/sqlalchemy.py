@@ -9,9 +9,19 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from flask.ext import security
-from flask.ext.security import UserMixin, RoleMixin
-from flask.ext.security.datastore import UserDatastore
+from __future__ import absolute_import
+
+from sqlalchemy import and_, bindparam, func, or_, select
+from sqlalchemy.orm import (class_mapper, defer, joinedload, ColumnProperty,
+    RelationshipProperty)
+from flask.ext.security import UserMixin, RoleMixin, UserDatastoreError
+from flask.ext.security.datastore import (UserDatastore, normalize_identifier,
+    prefix_range)
+
+def _chunks(items, size=500):
+    # stay below the limit on the number of query parameters
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
     
 class SQLAlchemyUserDatastore(UserDatastore):
     """A SQLAlchemy datastore implementation for Flask-Security. 
@@ -28,51 +38,100 @@ class SQLAlchemyUserDatastore(UserDatastore):
         
         db = SQLAlchemy(app)
         Security(app, SQLAlchemyUserDatastore(db))
+    
+    :param db: The Flask-SQLAlchemy instance
+    :param user_account_mixin: An optional mixin class that specifies additional
+                               fields to be added to the user model
+    :param bind_key: The optional key of the `SQLALCHEMY_BINDS` database the 
+                     user and role tables are stored in
     """
     
+    def __init__(self, db, user_account_mixin=None, bind_key=None):
+        super(SQLAlchemyUserDatastore, self).__init__(db, user_account_mixin)
+        self.bind_key = bind_key
+    
     def get_models(self):
         db = self.db
+        bind_key = self.bind_key
         
         roles_users = db.Table('roles_users',
             db.Column('user_id', db.Integer(), db.ForeignKey('role.id')),
-            db.Column('role_id', db.Integer(), db.ForeignKey('user.id')))
+            db.Column('role_id', db.Integer(), db.ForeignKey('user.id')),
+            info={'bind_key': bind_key})
+        
+        roles_implied = db.Table('roles_implied',
+            db.Column('role_id', db.Integer(), db.ForeignKey('role.id')),
+            db.Column('implied_role_id', db.Integer(), db.ForeignKey('role.id')),
+            info={'bind_key': bind_key})
+        
+        role_bit_sequence = db.Table('role_bit_sequence',
+            db.Column('id', db.Integer(), primary_key=True),
+            db.Column('next_bit', db.Integer(), nullable=False),
+            info={'bind_key': bind_key})
         
         class Role(db.Model, RoleMixin):
             """SQLAlchemy Role model"""
             
+            __bind_key__ = bind_key
+            
             id = db.Column(db.Integer(), primary_key=True)
             name = db.Column(db.String(80), unique=True)
             description = db.Column(db.String(255))
+            bit = db.Column(db.Integer(), unique=True)
+            
+            implied_roles = db.relationship('Role', secondary=roles_implied,
+                primaryjoin=id == roles_implied.c.role_id,
+                secondaryjoin=id == roles_implied.c.implied_role_id)
             
-            def __init__(self, name=None, description=None):
+            def __init__(self, name=None, description=None, 
+                         implied_roles=None, bit=None):
                 self.name = name
                 self.description = description
+                self.implied_roles = implied_roles or []
+                self.bit = bit
               
         class User(db.Model, UserMixin, self.user_account_mixin):
             """SQLAlchemy User model"""
             
+            __bind_key__ = bind_key
+            
             id = db.Column(db.Integer, primary_key=True)
             username = db.Column(db.String(255), unique=True)
             email = db.Column(db.String(255), unique=True)
+            username_lower = db.Column(db.String(255), unique=True)
+            email_lower = db.Column(db.String(255), unique=True)
             password = db.Column(db.String(120))
             active = db.Column(db.Boolean())
+            role_mask = db.Column(db.BigInteger(), default=0)
             created_at = db.Column(db.DateTime())
             modified_at = db.Column(db.DateTime())
+            last_login_at = db.Column(db.DateTime(), index=True)
+            last_login_ip = db.Column(db.String(45))
+            login_count = db.Column(db.Integer(), default=0)
+            api_key_digest = db.Column(db.String(64), unique=True)
+            api_key_last_used_at = db.Column(db.DateTime())
             
             roles= db.relationship('Role', secondary=roles_users,
                                     backref=db.backref('users', lazy='dynamic'))
             
             def __init__(self, username=None, email=None, password=None, 
                          active=True, roles=None, 
-                         created_at=None, modified_at=None):
+                         created_at=None, modified_at=None,
+                         username_lower=None, email_lower=None, role_mask=0):
                 self.username = username
                 self.email = email
+                self.username_lower = username_lower
+                self.email_lower = email_lower
                 self.password = password
                 self.active = active
                 self.roles = roles or []
+                self.role_mask = role_mask
                 self.created_at = created_at
                 self.modified_at = modified_at
             
+        self.roles_users = roles_users
+        self.roles_implied = roles_implied
+        self.role_bit_sequence = role_bit_sequence
         return User, Role
     
     def _save_model(self, model):
@@ -81,12 +140,282 @@ class SQLAlchemyUserDatastore(UserDatastore):
         return model
     
     def _do_with_id(self, id):
-        return security.User.query.get(id)
+        return self.User.query.get(id)
+    
+    def _do_load_user(self, id):
+        return self.User.query.options(*self._load_options()).get(id)
+    
+    def _load_options(self):
+        key = (self.User, tuple(self.session_load_fields))
+        cache = self.__dict__.setdefault('_load_options_cache', {})
+        if key not in cache:
+            options = []
+            for prop in class_mapper(self.User).iterate_properties:
+                if prop.key in self.session_load_fields:
+                    if isinstance(prop, RelationshipProperty):
+                        options.append(joinedload(prop.key))
+                elif isinstance(prop, ColumnProperty):
+                    if not any(c.primary_key for c in prop.columns):
+                        options.append(defer(prop.key))
+            cache[key] = options
+        return cache[key]
     
     def _do_find_user(self, user):
-        return security.User.query.filter_by(username=user).first() or \
-               security.User.query.filter_by(email=user).first()
+        return self.User.query.filter_by(username_lower=user).first() or \
+               self.User.query.filter_by(email_lower=user).first() or \
+               self._find_unnormalized_user(user)
+    
+    def _do_has_unnormalized_users(self):
+        User = self.User
+        return self.db.session.query(User.id).filter(or_(
+            and_(User.username_lower == None, User.username != None),
+            and_(User.email_lower == None, User.email != None))).first() \
+            is not None
+    
+    def _do_find_unnormalized_user(self, user):
+        User = self.User
+        return User.query.filter(or_(
+            and_(User.username_lower == None, 
+                 func.lower(func.trim(User.username)) == user),
+            and_(User.email_lower == None, 
+                 func.lower(func.trim(User.email)) == user))).first()
+    
+    def _do_normalize_identifiers(self, chunk_size=1000):
+        # normalized in python, the SQL lower() of most databases differs
+        # from unicode.lower() outside of ASCII
+        User = self.User
+        table = User.__table__
+        statement = table.update() \
+            .where(table.c.id == bindparam('_id')) \
+            .values(username_lower=bindparam('_username'), 
+                    email_lower=bindparam('_email'))
+        count, last_id = 0, None
+        while True:
+            query = self.db.session.query(User.id, User.username, User.email)
+            if last_id is not None:
+                query = query.filter(User.id > last_id)
+            users = query.order_by(User.id).limit(chunk_size).all()
+            if not users:
+                return count
+            self.db.session.execute(statement, [
+                dict(_id=id, _username=normalize_identifier(username), 
+                     _email=normalize_identifier(email)) 
+                for id, username, email in users])
+            self.db.session.commit()
+            count += len(users)
+            last_id = users[-1].id
     
     def _do_find_role(self, role):
-        return security.Role.query.filter_by(name=role).first()
+        return self.Role.query.filter_by(name=role).first()
+    
+    def _roles_users_columns(self):
+        user_column = role_column = None
+        for column in self.roles_users.c:
+            for fk in column.foreign_keys:
+                if fk.column.table is self.Role.__table__:
+                    role_column = column
+                elif fk.column.table is self.User.__table__:
+                    user_column = column
+        return user_column, role_column
+    
+    def _do_get_role_bits(self):
+        Role = self.Role
+        rows = self.db.session.query(Role.name, Role.bit).filter(Role.bit != None)
+        return dict(rows)
+    
+    def _do_get_roles(self):
+        return self.Role.query.order_by(self.Role.id).all()
+    
+    def _do_get_roles_without_bit(self):
+        Role = self.Role
+        return Role.query.filter(Role.bit == None).order_by(Role.id).all()
+    
+    def _do_sync_role_masks(self):
+        User, Role = self.User, self.Role
+        user_column, role_column = self._roles_users_columns()
+        count = User.query.update({User.role_mask: 0}, 
+                                  synchronize_session=False)
+        for role in Role.query.filter(Role.bit != None):
+            members = select([user_column]).where(role_column == role.id)
+            User.query.filter(User.id.in_(members)).update(
+                {User.role_mask: User.role_mask.op('|')(1 << role.bit)}, 
+                synchronize_session=False)
+        self.db.session.commit()
+        return count
+    
+    def _do_allocate_role_bit(self):
+        session, table = self.db.session, self.role_bit_sequence
+        # the increment locks the sequence until the role is committed
+        if not session.execute(table.update().values(
+                next_bit=table.c.next_bit + 1)).rowcount:
+            # the bits assigned before the sequence existed are skipped
+            last = session.query(func.max(self.Role.bit)).scalar()
+            session.execute(table.insert().values(
+                id=1, next_bit=(-1 if last is None else last) + 2))
+        return session.execute(select([table.c.next_bit])).scalar() - 1
+    
+    def _do_get_user_fields(self):
+        return [prop.key for prop in class_mapper(self.User).iterate_properties
+                if isinstance(prop, ColumnProperty) and prop.key != 'id']
+    
+    def _do_get_recent_logins(self, limit):
+        User = self.User
+        return User.query.filter(User.last_login_at != None) \
+            .order_by(User.last_login_at.desc()).limit(limit) \
+            .values(User.id, User.last_login_at)
+    
+    def _do_find_user_by_api_key(self, digest):
+        return self.User.query.filter_by(api_key_digest=digest).first()
+    
+    def _do_record_api_key_uses(self, uses):
+        table = self.User.__table__
+        statement = table.update() \
+            .where(table.c.id == bindparam('_id')) \
+            .values(api_key_last_used_at=bindparam('_at'))
+        self.db.session.execute(statement, [
+            dict(_id=id, _at=at) for id, at in uses.items()])
+        self.db.session.commit()
+    
+    def _do_record_logins(self, logins):
+        table = self.User.__table__
+        statement = table.update() \
+            .where(table.c.id == bindparam('_id')) \
+            .values(last_login_at=bindparam('_at'), 
+                    last_login_ip=bindparam('_ip'),
+                    login_count=func.coalesce(table.c.login_count, 0) + 
+                                bindparam('_count'))
+        self.db.session.execute(statement, [
+            dict(_id=id, _at=at, _ip=ip, _count=count) 
+            for id, (at, ip, count) in logins.items()])
+        self.db.session.commit()
+    
+    def _do_iter_users(self, roles, chunk_size):
+        # keyset chunks like the MongoEngine datastore, a single cursor with
+        # yield_per is buffered entirely by most DBAPI drivers
+        User, Role = self.User, self.Role
+        query = self.db.session.query(User.id, User.username, User.email, 
+                                      User.active, User.created_at)
+        if roles:
+            query = query.filter(User.roles.any(
+                Role.id.in_([role.id for role in roles])))
+        
+        user_column, role_column = self._roles_users_columns()
+        last_id = None
+        while True:
+            chunk = query
+            if last_id is not None:
+                chunk = chunk.filter(User.id > last_id)
+            chunk = chunk.order_by(User.id).limit(chunk_size).all()
+            for user in self._export_chunk(chunk, user_column, role_column):
+                yield user
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1][0]
+    
+    def _export_chunk(self, chunk, user_column, role_column):
+        if not chunk:
+            return []
+        Role = self.Role
+        names = {}
+        rows = self.db.session.execute(
+            select([user_column, Role.name])
+            .where(role_column == Role.id)
+            .where(user_column.in_([row[0] for row in chunk])))
+        for user_id, name in rows:
+            names.setdefault(user_id, []).append(name)
+        keys = ('id', 'username', 'email', 'active', 'created_at')
+        return [dict(zip(keys, row), roles=names.get(row[0], [])) 
+                for row in chunk]
+    
+    def _do_search_users(self, prefix, roles, active, limit, after):
+        User = self.User
+        user_column, role_column = self._roles_users_columns()
+        query = self.db.session.query(User.id, User.username, User.email, 
+                                      User.active, User.created_at)
+        if prefix:
+            # ranges instead of LIKE so that the identifier indexes are used
+            low, high = prefix_range(prefix)
+            query = query.filter(or_(
+                and_(User.username_lower >= low, User.username_lower < high),
+                and_(User.email_lower >= low, User.email_lower < high)))
+        if roles:
+            query = query.filter(User.id.in_(select([user_column]).where(
+                role_column.in_([role.id for role in roles]))))
+        if active is not None:
+            query = query.filter(User.active == active)
+        if after is not None:
+            try:
+                query = query.filter(User.id > int(after))
+            except ValueError:
+                raise UserDatastoreError("Invalid cursor")
+        rows = query.order_by(User.id).limit(limit).all()
+        return self._export_chunk(rows, user_column, role_column)
+    
+    def _bulk_criterion(self, identifiers, roles):
+        User = self.User
+        criteria = []
+        if identifiers:
+            criteria.append(User.username_lower.in_(identifiers))
+            criteria.append(User.email_lower.in_(identifiers))
+        if roles:
+            user_column, role_column = self._roles_users_columns()
+            members = select([user_column]).where(
+                role_column.in_([role.id for role in roles]))
+            criteria.append(User.id.in_(members))
+        return or_(*criteria)
+    
+    def _do_set_active(self, active, identifiers, roles, return_ids):
+        User = self.User
+        query = User.query.filter(self._bulk_criterion(identifiers, roles)) \
+            .filter(or_(User.active != active, User.active == None))
+        ids = [id for id, in query.values(User.id)] if return_ids else None
+        count = query.update({User.active: active}, synchronize_session=False)
+        self.db.session.commit()
+        return count, ids
+    
+    def _do_delete_users(self, identifiers, roles, return_ids):
+        User = self.User
+        user_column, role_column = self._roles_users_columns()
+        query = User.query.filter(self._bulk_criterion(identifiers, roles))
+        # the ids are read first because the role criterion reads roles_users
+        ids = [id for id, in query.values(User.id)]
+        for chunk in _chunks(ids):
+            self.db.session.execute(self.roles_users.delete().where(
+                user_column.in_(chunk)))
+            self.db.session.execute(User.__table__.delete().where(
+                User.__table__.c.id.in_(chunk)))
+        self.db.session.commit()
+        return len(ids), ids if return_ids else None
+    
+    def _do_delete_role(self, role, return_ids):
+        User, Role = self.User, self.Role
+        session = self.db.session
+        user_column, role_column = self._roles_users_columns()
+        
+        ids = None
+        if return_ids:
+            ids = [id for id, in session.execute(
+                select([user_column]).where(role_column == role.id))]
+        
+        if role.bit is not None:
+            bit = 1 << role.bit
+            User.query.filter(User.role_mask.op('&')(bit) != 0).update(
+                {User.role_mask: User.role_mask.op('&')(~bit)}, 
+                synchronize_session=False)
+        
+        count = session.execute(self.roles_users.delete().where(
+            role_column == role.id)).rowcount
+        implied = self.roles_implied.c
+        session.execute(self.roles_implied.delete().where(or_(
+            implied.role_id == role.id, implied.implied_role_id == role.id)))
+        session.execute(Role.__table__.delete().where(
+            Role.__table__.c.id == role.id))
+        session.expunge(role)
+        session.commit()
+        return count, ids
+    
+    def _do_get_role_hierarchy(self):
+        roles = self.Role.query.options(joinedload('implied_roles'))
+        return dict((role.name, [r.name for r in role.implied_roles]) 
+                    for role in roles if role.implied_roles)
     
\ No newline at end of file
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.invalidation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains invalidation buses for use with the
+    `SECURITY_INVALIDATION_BUS` configuration value. A bus carries the changes
+    a process makes to users and roles to the other processes so that they
+    evict the affected entries of their caches.
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+
+from time import time
+
+from flask.ext.security.cache import create_private_file
+
+logger = logging.getLogger('flask_security.invalidation')
+
+
+class InvalidationBus(object):
+    """Base class of invalidation buses. A bus delivers the events published
+    by other processes to the callbacks subscribed in this process.
+    Implementations must implement :meth:`publish` and :meth:`listen`.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Registers a callback that is called with the kind of the changed
+        objects, `'user'` or `'role'`, and a tuple of their keys, user IDs or
+        role names, for every event published by another process.
+
+        :param callback: The callback
+        """
+        self.subscribers.append(callback)
+        return callback
+
+    def publish(self, kind, keys):
+        """Publishes a change to other processes.
+
+        :param kind: `'user'` or `'role'`
+        :param keys: The IDs of the changed users or the names of the changed
+                     roles
+        """
+        raise NotImplementedError
+
+    def listen(self):
+        """Makes sure events are being received by the current process. Called
+        before each request, so that each forked worker starts listening."""
+        raise NotImplementedError
+
+    def _deliver(self, kind, keys):
+        for callback in self.subscribers:
+            callback(kind, keys)
+
+
+class SQLiteInvalidationBus(InvalidationBus):
+    """An invalidation bus stored in a SQLite database file, for processes on
+    the same host such as the pre-forked workers of a gunicorn or uWSGI
+    server. Events are appended to a table that each process polls from a
+    background thread. Example configuration::
+
+        app.config['SECURITY_INVALIDATION_BUS'] = (
+            'flask.ext.security.invalidation.SQLiteInvalidationBus')
+        app.config['SECURITY_INVALIDATION_BUS_OPTIONS'] = {
+            'path': '/var/run/myapp/invalidation.sqlite'
+        }
+
+    When the bus is configured with `SECURITY_INVALIDATION_BUS` and no path is
+    specified, the file is stored in the application's instance folder. The
+    file is created readable by its owner only, so that other users of the
+    host cannot publish events.
+
+    :param path: The path to the database file
+    :param poll_interval: The number of seconds between polls
+    :param retention: The number of seconds events are kept. A process that
+                      does not poll for longer misses events
+    """
+
+    def __init__(self, path, poll_interval=1, retention=3600):
+        super(SQLiteInvalidationBus, self).__init__()
+        if not path:
+            raise ValueError('SQLiteInvalidationBus requires the path of its '
+                             'file')
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._token = uuid.uuid4().hex
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._writes = 0
+        self._stopped = threading.Event()
+        create_private_file(self.path)
+        self._execute('CREATE TABLE IF NOT EXISTS events ('
+                      'id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT, '
+                      'kind TEXT, key TEXT, created REAL)')
+        # forked workers inherit the position of the process that created
+        # the bus and receive the events published since
+        self._last_id = self._execute(
+            'SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+
+    def _origin(self):
+        return '%s:%s' % (self._token, os.getpid())
+
+    def _connection(self):
+        # connections must not be shared across threads or forked processes
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            conn = sqlite3.connect(self.path, timeout=10,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.connection, self._local.pid = conn, pid
+        return self._local.connection
+
+    def _execute(self, sql, *args):
+        return self._connection().execute(sql, args)
+
+    def publish(self, kind, keys):
+        if not keys:
+            return
+        origin, now = self._origin(), time()
+        self._connection().executemany(
+            'INSERT INTO events (origin, kind, key, created) '
+            'VALUES (?, ?, ?, ?)',
+            [(origin, kind, unicode(key), now) for key in keys])
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._execute('DELETE FROM events WHERE created < ?',
+                          now - self.retention)
+
+    def poll(self):
+        """Delivers the events published by other processes since the last
+        poll and returns the number of events that were delivered."""
+        with self._lock:
+            rows = self._execute('SELECT id, origin, kind, key FROM events '
+                                 'WHERE id > ? ORDER BY id',
+                                 self._last_id).fetchall()
+            if rows:
+                self._last_id = rows[-1][0]
+        origin, batches = self._origin(), []
+        for id, event_origin, kind, key in rows:
+            if event_origin == origin:
+                continue
+            if batches and batches[-1][0] == kind:
+                batches[-1][1].append(key)
+            else:
+                batches.append((kind, [key]))
+        for kind, keys in batches:
+            self._deliver(kind, tuple(keys))
+        return sum(len(keys) for kind, keys in batches)
+
+    def listen(self):
+        # the thread is started lazily so that each forked worker gets one
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run,
+                                      name='flask-security-invalidation')
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """Stops receiving events in the current process"""
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.poll()
+            except Exception, e:
+                logger.error('Error polling invalidation events: %s' % e)
+            self._stopped.wait(self.poll_interval)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.profiling
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the slow authentication log and the sampling
+    profiler of authentication requests
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import cProfile
+import json
+import logging
+import os
+import random
+import tempfile
+
+from datetime import datetime
+from functools import wraps
+from time import time
+
+from flask import g, request, _request_ctx_stack
+from flask.ext.login import current_user
+
+#: The logger that slow authentication records are written to
+slow_auth_logger = logging.getLogger('flask_security.slow_auth')
+
+
+class AuthTimer(object):
+    """Measures the duration of the phases of an authentication request"""
+
+    def __init__(self):
+        self.start = time()
+        self.phases = {}
+
+    def phase(self, name):
+        """Returns a context manager that adds the time spent in its block to
+        the duration of the specified phase.
+
+        :param name: The phase name"""
+        return _Phase(self.phases, name)
+
+
+class _Phase(object):
+    def __init__(self, phases, name):
+        self.phases, self.name = phases, name
+
+    def __enter__(self):
+        self.start = time()
+
+    def __exit__(self, *exc_info):
+        elapsed = time() - self.start
+        self.phases[self.name] = self.phases.get(self.name, 0) + elapsed
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_phase = _NullPhase()
+
+
+def auth_phase(name):
+    """Returns a context manager that times the specified phase of the current
+    authentication request. Does nothing if the request is not timed.
+
+    :param name: The phase name, e.g. `find_user` or `verify`"""
+    if _request_ctx_stack.top is None:
+        return _null_phase
+    timer = getattr(g, 'security_auth_timer', None)
+    return _null_phase if timer is None else timer.phase(name)
+
+
+def _has_file_handler(path):
+    path = os.path.abspath(path)
+    return any(getattr(h, 'baseFilename', None) == path
+               for h in slow_auth_logger.handlers)
+
+
+class AuthProfiler(object):
+    """View decorator that times the phases of authentication requests and
+    writes a JSON record to the `flask_security.slow_auth` logger for every
+    request that takes longer than `threshold` milliseconds. A fraction of the
+    requests can also be profiled with :mod:`cProfile`, the profiles are saved
+    in `profile_dir` and can be inspected offline with :mod:`pstats`. Profiled
+    requests are always logged so that their profile can be found.
+
+    :param threshold: The duration in milliseconds above which a request is
+                      logged. `None` disables the log
+    :param log_path: An optional file the records are appended to, one JSON
+                     object per line
+    :param profile_rate: The fraction of requests to profile, between 0 and 1
+    :param profile_dir: The directory profiles are saved in. Defaults to the
+                        system's temporary directory
+    """
+
+    def __init__(self, threshold=None, log_path=None, profile_rate=0,
+                 profile_dir=None):
+        self.threshold = threshold
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir or tempfile.gettempdir()
+        if log_path and not _has_file_handler(log_path):
+            handler = logging.FileHandler(log_path)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            slow_auth_logger.addHandler(handler)
+        if self and slow_auth_logger.level == logging.NOTSET:
+            # the records are info messages, which the default WARNING level
+            # of the root logger would drop
+            slow_auth_logger.setLevel(logging.INFO)
+
+    def __nonzero__(self):
+        return self.threshold is not None or self.profile_rate > 0
+
+    def __call__(self, fn):
+        @wraps(fn)
+        def decorated_view(*args, **kwargs):
+            timer = g.security_auth_timer = AuthTimer()
+            profiler = None
+            if self.profile_rate and random.random() < self.profile_rate:
+                profiler = cProfile.Profile()
+                profiler.enable()
+            status = 500
+            try:
+                response = fn(*args, **kwargs)
+                status = response.status_code
+                return response
+            finally:
+                profile_path = None
+                if profiler is not None:
+                    profiler.disable()
+                    profile_path = self._save_profile(profiler)
+                self._record(timer, status, profile_path)
+        return decorated_view
+
+    def _save_profile(self, profiler):
+        name = 'auth-%s-%s.prof' % (datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+                                    os.getpid())
+        path = os.path.join(self.profile_dir, name)
+        profiler.dump_stats(path)
+        return path
+
+    def _record(self, timer, status, profile_path):
+        total = (time() - timer.start) * 1000
+        if profile_path is None and (self.threshold is None or
+                                     total < self.threshold):
+            return
+        slow_auth_logger.info(json.dumps({
+            'time': datetime.utcnow().isoformat(),
+            'endpoint': request.endpoint,
+            'remote_addr': request.remote_addr,
+            'status': status,
+            'authenticated': current_user.is_authenticated(),
+            'total_ms': round(total, 3),
+            'phases': dict((name, round(duration * 1000, 3))
+                           for name, duration in timer.phases.items()),
+            'profile': profile_path
+        }))
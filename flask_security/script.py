@@ -9,8 +9,10 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import csv
 import json
 import re
+import sys
 from flask.ext.script import Command, Option
 from flask.ext.security import (UserCreationError, UserNotFoundError, 
                                 RoleNotFoundError, user_datastore) 
@@ -18,6 +20,20 @@ from flask.ext.security import (UserCreationError, UserNotFoundError,
 def pprint(obj):
     print json.dumps(obj, sort_keys=True, indent=4)
 
+def _json_default(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    return unicode(obj)
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = ','.join(value)
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return unicode(value).encode('utf-8')
+
 
 class CreateUserCommand(Command):
     """Create a user"""
@@ -81,6 +97,30 @@ class RemoveRoleCommand(_RoleCommand):
         user_datastore.remove_role_from_user(user_identifier, role_name)
         print "Role '%s' removed from user '%s' successfully" % (role_name, user_identifier)
 
+
+class _ImpliedRoleCommand(Command):
+    option_list = (
+        Option('-r', '--role',    dest='role_name'),
+        Option('-i', '--implied', dest='implied_role_name'),
+    )
+
+
+class AddImpliedRoleCommand(_ImpliedRoleCommand):
+    """Make a role imply another role"""
+    
+    def run(self, role_name, implied_role_name):
+        user_datastore.add_implied_role(role_name, implied_role_name)
+        print "Role '%s' now implies role '%s'" % (role_name, implied_role_name)
+
+
+class RemoveImpliedRoleCommand(_ImpliedRoleCommand):
+    """Make a role no longer imply another role"""
+    
+    def run(self, role_name, implied_role_name):
+        user_datastore.remove_implied_role(role_name, implied_role_name)
+        print "Role '%s' no longer implies role '%s'" % (role_name, 
+                                                          implied_role_name)
+
     
 class _ToggleActiveCommand(Command):
     option_list = (
@@ -99,4 +139,187 @@ class ActivateUserCommand(_ToggleActiveCommand):
     
     def run(self, user_identifier):
         user_datastore.activate_user(user_identifier)
-        print "User '%s' has been activated" % user_identifier
\ No newline at end of file
+        print "User '%s' has been activated" % user_identifier
+
+class _BulkUserCommand(Command):
+    option_list = (
+        Option('-u', '--users', dest='users', default=''),
+        Option('-r', '--roles', dest='roles', default=''),
+        Option('-f', '--file',  dest='file',  default=None),
+    )
+    
+    def _parse(self, users, roles, file):
+        ui, ri = re.sub(r'\s', '', users), re.sub(r'\s', '', roles)
+        users = [] if ui == '' else ui.split(',')
+        roles = [] if ri == '' else ri.split(',')
+        if file:
+            # one user identifier per line
+            with open(file) as f:
+                users.extend(line.strip() for line in f if line.strip())
+        return users, roles
+
+
+class DeactivateUsersCommand(_BulkUserCommand):
+    """Deactivate many users by identifier, role or file of identifiers"""
+    
+    def run(self, users, roles, file):
+        users, roles = self._parse(users, roles, file)
+        count = user_datastore.deactivate_users(users=users, roles=roles)
+        print "Deactivated %s user(s)" % count
+
+
+class ActivateUsersCommand(_BulkUserCommand):
+    """Activate many users by identifier, role or file of identifiers"""
+    
+    def run(self, users, roles, file):
+        users, roles = self._parse(users, roles, file)
+        count = user_datastore.activate_users(users=users, roles=roles)
+        print "Activated %s user(s)" % count
+
+
+class DeleteUsersCommand(_BulkUserCommand):
+    """Delete many users by identifier, role or file of identifiers"""
+    
+    def run(self, users, roles, file):
+        users, roles = self._parse(users, roles, file)
+        count = user_datastore.delete_users(users=users, roles=roles)
+        print "Deleted %s user(s)" % count
+
+
+class DeleteUserCommand(Command):
+    """Delete a user"""
+    
+    option_list = (
+        Option('-u', '--user', dest='user_identifier'),
+    )
+    
+    def run(self, user_identifier):
+        user_datastore.delete_user(user_identifier)
+        print "User '%s' has been deleted" % user_identifier
+
+
+class DeleteRoleCommand(Command):
+    """Delete a role and remove it from its users"""
+    
+    option_list = (
+        Option('-r', '--role', dest='role_name'),
+    )
+    
+    def run(self, role_name):
+        count = user_datastore.delete_role(role_name)
+        print "Role '%s' has been deleted and removed from %s user(s)" % (
+            role_name, count)
+
+
+class ExportUsersCommand(Command):
+    """Export users and their role names as JSON lines or CSV"""
+    
+    fields = ('id', 'username', 'email', 'active', 'created_at', 'roles')
+    
+    option_list = (
+        Option('-f', '--format',     dest='format',     default='jsonl'),
+        Option('-o', '--output',     dest='output',     default='-'),
+        Option('-r', '--roles',      dest='roles',      default=''),
+        Option('-c', '--chunk-size', dest='chunk_size', default=1000, 
+               type=int),
+    )
+    
+    def run(self, format, output, roles, chunk_size):
+        ri = re.sub(r'\s', '', roles)
+        roles = [] if ri == '' else ri.split(',')
+        users = user_datastore.iter_users(roles=roles, chunk_size=chunk_size)
+        
+        out = sys.stdout if output == '-' else open(output, 'wb')
+        try:
+            if format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(self.fields)
+                for user in users:
+                    writer.writerow([_csv_value(user[f]) for f in self.fields])
+            else:
+                for user in users:
+                    out.write(json.dumps(user, default=_json_default) + '\n')
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+
+class _ApiKeyCommand(Command):
+    option_list = (
+        Option('-u', '--user', dest='user_identifier'),
+    )
+
+
+class IssueApiKeyCommand(_ApiKeyCommand):
+    """Issue an API key to a user, replacing the user's current key"""
+    
+    def run(self, user_identifier):
+        key = user_datastore.issue_api_key(user_identifier)
+        print "Issued API key to '%s': %s" % (user_identifier, key)
+
+
+class RotateApiKeyCommand(_ApiKeyCommand):
+    """Replace the API key of a user with a new key"""
+    
+    def run(self, user_identifier):
+        key = user_datastore.rotate_api_key(user_identifier)
+        print "Rotated API key of '%s': %s" % (user_identifier, key)
+
+
+class RevokeApiKeyCommand(_ApiKeyCommand):
+    """Revoke the API key of a user"""
+    
+    def run(self, user_identifier):
+        user_datastore.revoke_api_key(user_identifier)
+        print "Revoked API key of '%s'" % user_identifier
+
+
+class NormalizeIdentifiersCommand(Command):
+    """Populate the normalized username and email fields of existing users"""
+    
+    def run(self):
+        count = user_datastore.normalize_identifiers()
+        print "Normalized identifiers of %s user(s)" % count
+
+
+class SyncRoleMasksCommand(Command):
+    """Assign role bits and recompute the role mask of every user"""
+    
+    def run(self):
+        count = user_datastore.sync_role_masks()
+        print "Synchronized role masks of %s user(s)" % count
+
+
+class EnsureIndexesCommand(Command):
+    """Create the user and role indexes"""
+    
+    def run(self):
+        user_datastore.ensure_indexes()
+        print "Indexes created successfully"
+
+
+class WarmCacheCommand(Command):
+    """Preload the roles and the most recently active users into the caches"""
+    
+    option_list = (
+        Option('-l', '--limit', dest='limit', default=1000, type=int),
+        Option('-t', '--timeout', dest='timeout', default=None, type=float),
+    )
+    
+    def run(self, limit, timeout):
+        count = user_datastore.warm_cache(limit=limit, timeout=timeout)
+        print "Cached %s user(s)" % count
+
+
+class RebalanceShardsCommand(Command):
+    """Replicate the roles of a sharded datastore to every shard and move the 
+    users to the shards they belong to. Run it again if it is interrupted"""
+    
+    option_list = (
+        Option('-c', '--chunk-size', dest='chunk_size', default=1000, 
+               type=int),
+    )
+    
+    def run(self, chunk_size):
+        count = user_datastore.rebalance(chunk_size=chunk_size)
+        print "Moved %s user(s)" % count
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.tracking
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the buffered login tracker used when the
+    `SECURITY_TRACKABLE` configuration value is enabled and the tracker of
+    API key uses
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import os
+import threading
+
+from datetime import datetime
+
+
+class _BufferedTracker(object):
+    # buffers updates in memory and hands them to _write in batches from a
+    # background thread
+
+    thread_name = 'flask-security-tracker'
+    error_message = 'Error writing tracked updates: %s'
+
+    def __init__(self, app, datastore, flush_interval=5, buffer_size=100):
+        self.app = app
+        self.datastore = datastore
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._pid = None
+        atexit.register(self.flush)
+
+    def _add(self, key, update):
+        with self._lock:
+            self._buffer[key] = update(self._buffer.get(key))
+            size = len(self._buffer)
+        self._ensure_thread()
+        if size >= self.buffer_size:
+            self._event.set()
+
+    def _write(self, pending):
+        raise NotImplementedError
+
+    def _merge(self, entry, newer):
+        # combines a buffered entry with the entry of a newer update
+        return newer
+
+    def flush(self):
+        """Writes all buffered updates to the user datastore. The updates 
+        are buffered again if they cannot be written."""
+        with self._lock:
+            pending, self._buffer = self._buffer, {}
+        if pending:
+            try:
+                with self.app.test_request_context():
+                    self._write(pending)
+            except Exception:
+                self._restore(pending)
+                raise
+
+    def _restore(self, pending):
+        # the updates buffered since the failed flush are newer
+        with self._lock:
+            for key, entry in pending.items():
+                if key in self._buffer:
+                    entry = self._merge(entry, self._buffer[key])
+                self._buffer[key] = entry
+
+    def _ensure_thread(self):
+        # the thread is started lazily so that each forked worker gets one
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid == os.getpid():
+                    return
+                self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name=self.thread_name)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.flush_interval)
+            self._event.clear()
+            try:
+                self.flush()
+            except Exception, e:
+                self.app.logger.error(self.error_message % e)
+
+
+class LoginTracker(_BufferedTracker):
+    """Records the last login time, last login IP address and login count of
+    users. Logins are buffered in memory and written to the user datastore in
+    batches by a background thread, either every `flush_interval` seconds or
+    as soon as `buffer_size` users are buffered, and when the process exits.
+    Recording a login therefore adds no database round trip to the login
+    request.
+
+    :param app: The application
+    :param datastore: The user datastore
+    :param flush_interval: The maximum number of seconds logins are buffered
+    :param buffer_size: The number of buffered users that triggers a flush
+    """
+
+    thread_name = 'flask-security-login-tracker'
+    error_message = 'Error recording logins: %s'
+
+    def record(self, user_id, ip, at=None):
+        """Buffers a login.
+
+        :param user_id: The ID of the user that logged in
+        :param ip: The IP address the user logged in from
+        :param at: The login time. Defaults to now
+        """
+        at = at or datetime.utcnow()
+        def update(entry):
+            if entry is None:
+                return [at, ip, 1]
+            return [at, ip, entry[2] + 1]
+        self._add(user_id, update)
+
+    def _merge(self, entry, newer):
+        return [newer[0], newer[1], entry[2] + newer[2]]
+
+    def _write(self, pending):
+        self.datastore.record_logins(
+            dict((k, tuple(v)) for k, v in pending.items()))
+
+
+class ApiKeyTracker(_BufferedTracker):
+    """Records the time the API key of each user was last used. Uses are
+    buffered and written in batches like the logins of a
+    :class:`LoginTracker`, so authenticating with an API key adds no write
+    to the request.
+
+    :param app: The application
+    :param datastore: The user datastore
+    :param flush_interval: The maximum number of seconds uses are buffered
+    :param buffer_size: The number of buffered users that triggers a flush
+    """
+
+    thread_name = 'flask-security-api-key-tracker'
+    error_message = 'Error recording API key uses: %s'
+
+    def record(self, user_id, at=None):
+        """Buffers a use of a user's API key.
+
+        :param user_id: The ID of the user the key belongs to
+        :param at: The time the key was used. Defaults to now
+        """
+        at = at or datetime.utcnow()
+        self._add(user_id, lambda entry: at)
+
+    def _write(self, pending):
+        self.datastore.record_api_key_uses(pending)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+    flask.ext.security.warmup
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    This module contains the cache warmer used when the
+    `SECURITY_CACHE_WARMUP` configuration value is enabled
+
+    :copyright: (c) 2012 by Matt Wright.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import os
+import threading
+
+from time import time
+
+
+class CacheWarmer(object):
+    """Preloads the roles and the most recently active users of a user
+    datastore into its caches from a background thread, so that the
+    application can serve requests while the caches are filled. See
+    :meth:`~flask_security.datastore.UserDatastore.warm_cache`.
+
+    :param app: The application
+    :param datastore: The user datastore
+    :param limit: The maximum number of users to preload
+    :param timeout: The number of seconds after which no more users are
+                    loaded
+    """
+
+    def __init__(self, app, datastore, limit=1000, timeout=30):
+        self.app = app
+        self.datastore = datastore
+        self.limit = limit
+        self.timeout = timeout
+        self.count = None
+        self.finished = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        """Starts warming the caches unless this process has already started.
+        Runs before every request, so that each forked worker warms its own
+        caches once it serves requests."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self.start()
+
+    def start(self):
+        """Starts warming the caches in a daemon thread"""
+        self.finished.clear()
+        thread = threading.Thread(target=self.run,
+                                  name='flask-security-cache-warmer')
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, timeout=None):
+        """Blocks until the caches are warm or the timeout expires and returns
+        `True` if the caches are warm.
+
+        :param timeout: The optional number of seconds to wait
+        """
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def run(self):
+        """Warms the caches in the current thread"""
+        start = time()
+        try:
+            with self.app.test_request_context():
+                self.count = self.datastore.warm_cache(self.limit,
+                                                       self.timeout)
+            self.app.logger.info('Preloaded %s user(s) in %.2fs' % (
+                self.count, time() - start))
+        except Exception, e:
+            self.app.logger.error('Error warming caches: %s' % e)
+        finally:
+            self.finished.set()
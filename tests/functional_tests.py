@@ -1,5 +1,24 @@
+import csv
+import json
+import logging
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import datetime, timedelta
 from example import app
+from flask import Flask, g, request
+from flask_security import (current_user, filter_permitted, 
+                            UserCreationError, UserDatastoreError, 
+                            UserNotFoundError, RoleNotFoundError)
+from flask_security import Security, UserSnapshot, user_datastore
+from flask_security.datastore import user_cache_key
+from flask_security.datastore.sharded import (ShardedUserDatastore, 
+                                              jump_hash)
+from flask_security.datastore.sqlalchemy import SQLAlchemyUserDatastore
+from flask_security.profiling import AuthProfiler, slow_auth_logger
+from flask_security.script import EnsureIndexesCommand, ExportUsersCommand
+from flask.ext.sqlalchemy import SQLAlchemy
 
 class SecurityTest(unittest.TestCase):
     
@@ -14,6 +33,14 @@ class SecurityTest(unittest.TestCase):
         
         self.client = self.app.test_client()
         
+    def tearDown(self):
+        # the trackers would otherwise flush into the next test's database
+        for tracker in (getattr(self.app, 'login_tracker', None),
+                        self.app.security.api_key_tracker):
+            if tracker is not None:
+                tracker.flush()
+        super(SecurityTest, self).tearDown()
+        
     def _create_app(self, auth_config):
         return app.create_sqlalchemy_app(auth_config)
     
@@ -34,6 +61,11 @@ class SecurityTest(unittest.TestCase):
     
     def logout(self, endpoint=None):
         return self._get(endpoint or '/logout', follow_redirects=True)
+    
+    def http_get(self, username, password, route='/http'):
+        credentials = ('%s:%s' % (username, password)).encode('base64')
+        return self.client.get(route, headers={
+            'Authorization': 'Basic %s' % credentials.strip()})
 
 class DefaultSecurityTests(SecurityTest):
     
@@ -61,6 +93,10 @@ class DefaultSecurityTests(SecurityTest):
         r = self.authenticate("matt", "bogus")
         assert "Password does not match" in r.data
         
+    def test_authenticate_case_insensitive(self):
+        r = self.authenticate("MATT@lp.com", "password")
+        assert 'Home Page' in r.data
+        
     def test_inactive_user(self):
         r = self.authenticate("tiya", "password")
         assert "Inactive user" in r.data
@@ -99,6 +135,32 @@ class DefaultSecurityTests(SecurityTest):
         self.authenticate("jill", "password")
         r = self._get("/admin_or_editor", follow_redirects=True)
         self.assertIn('Home Page', r.data)
+        
+    def test_filter_permitted(self):
+        required = {'a': [('admin', 'editor')], 'b': ['editor', 'author'], 
+                    'c': None, 'd': [], 'e': ['author']}
+        
+        @self.app.route('/items')
+        def items():
+            return ','.join(filter_permitted(sorted(required), required.get))
+        
+        self.authenticate("joe", "password")
+        self.assertEqual('b,c', self._get('/items').data)
+        
+    def test_implied_roles(self):
+        self.authenticate("matt", "password")
+        r = self._get("/editor", follow_redirects=True)
+        self.assertIn('Home Page', r.data)
+        
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            datastore.add_implied_role('admin', 'editor')
+            datastore.add_implied_role('editor', 'author')
+            self.assertTrue(datastore.find_user('joe').has_role('author'))
+            self.assertFalse(datastore.find_user('joe').has_role('admin'))
+            
+        r = self._get("/editor")
+        self.assertIn('Editor Page', r.data)
 
 
 class ConfiguredSecurityTests(SecurityTest):    
@@ -126,6 +188,1103 @@ class ConfiguredSecurityTests(SecurityTest):
         r = self.logout(endpoint="/custom_logout")
         assert 'Post Logout' in r.data
 
+
+class EndpointRedirectSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_POST_LOGIN': 'post_login',
+        'SECURITY_POST_LOGOUT': 'post_logout'
+    }
+    
+    def test_authenticate(self):
+        r = self.authenticate("matt", "password")
+        self.assertIn('Post Login', r.data)
+        
+    def test_logout(self):
+        self.authenticate("matt", "password")
+        r = self.logout()
+        self.assertIn('Post Logout', r.data)
+        
+    def test_next_endpoint_and_url(self):
+        r = self.authenticate("matt", "password", endpoint="/auth?next=profile")
+        self.assertIn('Profile Page', r.data)
+        self.logout()
+        r = self.authenticate("matt", "password", endpoint="/auth?next=/admin")
+        self.assertIn('Admin Page', r.data)
+        
+    def test_classifies_endpoints(self):
+        resolver = self.app.redirect_resolver
+        self.assertTrue(resolver.is_endpoint('profile'))
+        self.assertTrue(resolver.is_endpoint('auth.logout'))
+        self.assertFalse(resolver.is_endpoint('/profile'))
+        self.assertFalse(resolver.is_endpoint('static'))
+        with self.app.test_request_context():
+            self.assertEqual('static', resolver.resolve('static'))
+            self.assertEqual('/profile', resolver.resolve('profile'))
+            self.assertEqual('/post_login', 
+                             resolver.config_url('SECURITY_POST_LOGIN'))
+            
+    def test_relative_endpoints_are_cached_per_blueprint(self):
+        resolver = self.app.redirect_resolver
+        self.app.config['SECURITY_POST_LOGIN'] = '.logout'
+        with self.app.test_request_context('/auth', method='POST'):
+            self.assertEqual('auth', request.blueprint)
+            self.assertEqual('/logout', 
+                             resolver.config_url('SECURITY_POST_LOGIN'))
+        with self.app.test_request_context('/profile'):
+            self.assertEqual('.logout', 
+                             resolver.config_url('SECURITY_POST_LOGIN'))
+
+
+class UserCacheSecurityTests(DefaultSecurityTests):
+    
+    AUTH_CONFIG = {
+        'SECURITY_USER_CACHE': 'flask.ext.security.cache.SQLiteCache',
+        'SECURITY_USER_CACHE_OPTIONS': {
+            'path': '/tmp/flask_security_test_cache.sqlite'
+        }
+    }
+    
+    def setUp(self):
+        super(UserCacheSecurityTests, self).setUp()
+        self.app.user_datastore.user_cache.clear()
+        
+    def test_removed_role_invalidates_cached_user(self):
+        self.authenticate("matt", "password")
+        self.assertIn('Admin Page', self._get("/admin").data)
+        
+        with self.app.test_request_context():
+            self.app.user_datastore.remove_role_from_user('matt', 'admin')
+            
+        r = self._get("/admin", follow_redirects=True)
+        self.assertIn('Home Page', r.data)
+        
+    def test_deactivate_users_invalidates_cached_users(self):
+        self.authenticate("matt", "password")
+        self._get("/profile")
+        
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            matt = datastore.find_user('matt')
+            key = user_cache_key(matt.id)
+            self.assertTrue(datastore.user_cache.get(key)['active'])
+            
+            datastore.deactivate_users(roles=['admin'])
+            self.assertIsNone(datastore.user_cache.get(key))
+            self.assertFalse(datastore.load_user_snapshot(matt.id).active)
+
+
+class CacheWarmupSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = dict(UserCacheSecurityTests.AUTH_CONFIG, **{
+        'SECURITY_TRACKABLE': True,
+        'SECURITY_CACHE_WARMUP': True,
+        'SECURITY_CACHE_WARMUP_USERS': 2
+    })
+    
+    def setUp(self):
+        super(CacheWarmupSecurityTests, self).setUp()
+        # started by the first request of the process
+        self.assertFalse(self.app.cache_warmer.wait(0))
+        self._get('/')
+        self.assertTrue(self.app.cache_warmer.wait(10))
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            datastore.user_cache.clear()
+            now = datetime.utcnow()
+            datastore.record_logins(dict(
+                (datastore.find_user(name).id, 
+                 (now - timedelta(minutes=i), '10.0.0.1', 1))
+                for i, name in enumerate(('joe', 'matt', 'jill'))))
+        
+    def test_warm_cache_loads_recently_active_users(self):
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            self.assertEqual(1, datastore.warm_cache(limit=1))
+            self.assertEqual(1, datastore.warm_cache(limit=2))
+            self.assertEqual(0, datastore.warm_cache(limit=2))
+            
+            for name, cached in (('joe', True), ('matt', True), 
+                                 ('jill', False), ('tiya', False)):
+                key = user_cache_key(datastore.find_user(name).id)
+                self.assertEqual(cached, 
+                                 datastore.user_cache.get(key) is not None)
+                
+    def test_warm_cache_stops_at_timeout(self):
+        with self.app.test_request_context():
+            self.assertEqual(0, self.app.user_datastore.warm_cache(timeout=0))
+        
+    def test_cache_warmer_runs_in_background(self):
+        warmer = self.app.cache_warmer
+        warmer.start()
+        self.assertTrue(warmer.wait(10))
+        self.assertEqual(2, warmer.count)
+        
+        self.authenticate('matt', 'password')
+        self.assertIn('Admin Page', self._get('/admin').data)
+
+
+class InvalidationBusSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_USER_CACHE': 'werkzeug.contrib.cache.SimpleCache',
+        'SECURITY_INVALIDATION_BUS': 
+            'flask.ext.security.invalidation.SQLiteInvalidationBus',
+        'SECURITY_INVALIDATION_BUS_OPTIONS': {
+            'path': '/tmp/flask_security_test_invalidation.sqlite',
+            'poll_interval': 60
+        }
+    }
+    
+    def setUp(self):
+        super(InvalidationBusSecurityTests, self).setUp()
+        self._get('/')
+        # another worker of the same application, with its own caches
+        self.worker = app.create_sqlalchemy_app(self.AUTH_CONFIG)
+        self.bus = self.worker.user_datastore.invalidation_bus
+        
+    def test_role_changes_are_evicted(self):
+        with self.worker.test_request_context():
+            datastore = self.worker.user_datastore
+            self.assertNotIn('author', datastore.get_effective_roles(['editor']))
+        
+        with self.app.test_request_context():
+            self.app.user_datastore.add_implied_role('editor', 'author')
+            
+        with self.worker.test_request_context():
+            self.assertNotIn('author', datastore.get_effective_roles(['editor']))
+            self.assertEqual(1, self.bus.poll())
+            self.assertIn('author', datastore.get_effective_roles(['editor']))
+            
+    def test_user_changes_are_evicted(self):
+        with self.worker.test_request_context():
+            datastore = self.worker.user_datastore
+            matt = datastore.find_user('matt')
+            self.assertIn('admin', 
+                          datastore.load_user_snapshot(matt.id).get_role_names())
+        
+        with self.app.test_request_context():
+            self.app.user_datastore.remove_role_from_user('matt', 'admin')
+            self.assertEqual(0, self.app.user_datastore.invalidation_bus.poll())
+            
+        with self.worker.test_request_context():
+            self.assertIn('admin', 
+                          datastore.load_user_snapshot(matt.id).get_role_names())
+            self.assertEqual(1, self.bus.poll())
+            self.assertNotIn('admin', 
+                          datastore.load_user_snapshot(matt.id).get_role_names())
+
+
+class RoleHierarchyTTLSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_ROLE_HIERARCHY_TTL': 0
+    }
+    
+    def setUp(self):
+        super(RoleHierarchyTTLSecurityTests, self).setUp()
+        self._get('/')
+        # another worker of the same application, without an invalidation bus
+        self.worker = app.create_sqlalchemy_app(self.AUTH_CONFIG)
+        
+    def _add_implied_role(self):
+        with self.worker.test_request_context():
+            datastore = self.worker.user_datastore
+            self.assertNotIn('author', datastore.get_effective_roles(['editor']))
+        
+        with self.app.test_request_context():
+            self.app.user_datastore.add_implied_role('editor', 'author')
+        
+    def test_hierarchy_changes_expire(self):
+        self._add_implied_role()
+        with self.worker.test_request_context():
+            datastore = self.worker.user_datastore
+            self.assertIn('author', datastore.get_effective_roles(['editor']))
+            self.assertTrue(datastore.find_user('joe').has_role('author'))
+            
+    def test_hierarchy_is_cached_without_ttl(self):
+        self.worker.user_datastore.role_hierarchy_ttl = None
+        self._add_implied_role()
+        with self.worker.test_request_context():
+            datastore = self.worker.user_datastore
+            self.assertNotIn('author', datastore.get_effective_roles(['editor']))
+
+
+class DetachedUserSecurityTests(DefaultSecurityTests):
+    
+    AUTH_CONFIG = {
+        'SECURITY_DETACHED_USER': True
+    }
+    
+    def test_current_user_is_snapshot(self):
+        with self.app.test_client() as client:
+            client.post('/auth', data=dict(username='matt', password='password'))
+            client.get('/profile')
+            user = current_user._get_current_object()
+            
+            self.assertIsInstance(user, UserSnapshot)
+            self.assertFalse(hasattr(user, '__dict__'))
+            self.assertEqual(('admin',), user.get_role_names())
+            self.assertTrue(user.has_role('admin'))
+            self.assertRaises(AttributeError, setattr, user, 'active', False)
+            self.assertEqual('matt@lp.com', user.get_model().email)
+
+
+class RoleBitmaskSecurityTests(DefaultSecurityTests):
+    
+    AUTH_CONFIG = {
+        'SECURITY_ROLE_BITMASK': True
+    }
+    
+    def test_identity_uses_role_mask(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            joe = datastore.find_user('joe')
+            joe.role_mask |= datastore.get_role_bits()['admin']
+            datastore._save_model(joe)
+            
+        self.authenticate("joe", "password")
+        r = self._get("/admin")
+        self.assertIn('Admin Page', r.data)
+        
+    def test_sync_role_masks(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            User = datastore.find_user('matt').__class__
+            Role = datastore.find_role('admin').__class__
+            Role.query.update({'bit': None})
+            User.query.update({'role_mask': 0})
+            
+            self.assertEqual(4, datastore.sync_role_masks())
+            self.assertTrue(datastore.find_user('matt').has_role('admin'))
+            self.assertFalse(datastore.find_user('joe').has_role('admin'))
+            
+    def test_delete_role_clears_role_bit(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            datastore.add_role_to_user('joe', 'admin')
+            datastore.delete_role('admin')
+            
+            self.assertEqual(datastore.get_role_bits()['editor'], 
+                             datastore.find_user('joe').role_mask)
+            self.assertEqual(0, datastore.find_user('matt').role_mask)
+            
+    def test_role_bits_are_not_reused(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            self.assertEqual(3, datastore.create_role(name='reviewer').bit)
+            datastore.delete_role('reviewer')
+            datastore.delete_role('admin')
+            
+            self.assertEqual(4, datastore.create_role(name='publisher').bit)
+            Role = datastore.find_role('editor').__class__
+            Role.query.filter_by(name='author').update({'bit': None})
+            datastore.sync_role_masks()
+            self.assertEqual(5, datastore.find_role('author').bit)
+            
+    def test_implied_role_without_bit(self):
+        self._get('/')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            datastore.add_implied_role('admin', 'author')
+            Role = datastore.find_role('author').__class__
+            Role.query.filter_by(name='author').update({'bit': None})
+            datastore.db.session.commit()
+            datastore._invalidate_role_bits()
+            
+        self.authenticate("matt", "password")
+        self.assertIn('Admin Page', self._get('/admin').data)
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            mask = datastore.find_user('matt').role_mask
+            self.assertTrue(datastore.mask_has_role(mask, 'admin'))
+            self.assertFalse(datastore.mask_has_role(mask, 'author'))
+
+
+class TrackableSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_TRACKABLE': True,
+        'SECURITY_TRACKABLE_FLUSH_INTERVAL': 60
+    }
+    
+    def test_logins_are_buffered_and_flushed(self):
+        for i in range(2):
+            self.client.post('/auth', environ_base={'REMOTE_ADDR': '10.0.0.1'},
+                             data=dict(username='matt', password='password'))
+            self.logout()
+            
+        with self.app.test_request_context():
+            matt = self.app.user_datastore.find_user('matt')
+            self.assertIsNone(matt.last_login_at)
+            
+        self.app.login_tracker.flush()
+        
+        with self.app.test_request_context():
+            matt = self.app.user_datastore.find_user('matt')
+            self.assertEqual(2, matt.login_count)
+            self.assertEqual('10.0.0.1', matt.last_login_ip)
+            self.assertIsNotNone(matt.last_login_at)
+            
+    def test_failed_flushes_keep_the_logins(self):
+        tracker = self.app.login_tracker
+        datastore = self.app.user_datastore
+        record_logins = datastore.record_logins
+        def fail(logins):
+            raise IOError('database is down')
+        
+        with self.app.test_request_context():
+            matt_id = datastore.find_user('matt').get_id()
+        
+        tracker.record(matt_id, '10.0.0.1')
+        datastore.record_logins = fail
+        self.assertRaises(IOError, tracker.flush)
+        datastore.record_logins = record_logins
+        tracker.record(matt_id, '10.0.0.2')
+        tracker.flush()
+        
+        with self.app.test_request_context():
+            matt = datastore.find_user('matt')
+            self.assertEqual(2, matt.login_count)
+            self.assertEqual('10.0.0.2', matt.last_login_ip)
+
+
+class ExemptRoutesSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_EXEMPT_ROUTES': ['health', '/public']
+    }
+    
+    def setUp(self):
+        super(ExemptRoutesSecurityTests, self).setUp()
+        self.loaded = []
+        datastore = self.app.user_datastore
+        load_user = datastore.load_user
+        datastore.load_user = lambda id: self.loaded.append(id) or load_user(id)
+        
+        for rule in ('/health', '/public/page', '/publication', '/page'):
+            self.app.add_url_rule(rule, rule.split('/')[-1], self.whoami)
+    
+    def whoami(self):
+        return 'anonymous' if current_user.is_anonymous() else 'user'
+        
+    def test_exempt_routes_skip_user_loading(self):
+        self.authenticate("matt", "password")
+        del self.loaded[:]
+        
+        self.assertEqual('anonymous', self._get('/health').data)
+        self.assertEqual('anonymous', self._get('/public/page').data)
+        self.assertEqual([], self.loaded)
+        
+        self.assertEqual('user', self._get('/page').data)
+        self.assertEqual(1, len(self.loaded))
+        # prefixes only match whole path segments
+        self.assertEqual('user', self._get('/publication').data)
+        self.assertIn('Profile Page', self._get('/profile').data)
+
+
+class JsonAuthSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_JSON_AUTH_URL': '/auth.json',
+        'SECURITY_JSON_LOGOUT_URL': '/logout.json'
+    }
+    
+    def json_authenticate(self, username, password):
+        data = json.dumps(dict(username=username, password=password))
+        return self.client.post('/auth.json', data=data, 
+                                content_type='application/json')
+    
+    def test_authenticate(self):
+        r = self.json_authenticate("matt", "password")
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('matt', json.loads(r.data)['username'])
+        self.assertIn('Profile Page', self._get('/profile').data)
+        
+    def test_bad_password(self):
+        r = self.json_authenticate("matt", "bogus")
+        self.assertEqual(401, r.status_code)
+        self.assertEqual('Password does not match', json.loads(r.data)['error'])
+        
+    def test_unprovided_password(self):
+        r = self.json_authenticate("matt", "")
+        self.assertEqual(400, r.status_code)
+        
+    def test_non_string_credentials(self):
+        for username, password in ((1, 'password'), ('matt', {'a': 1}), 
+                                   (['matt'], None)):
+            r = self.json_authenticate(username, password)
+            self.assertEqual(400, r.status_code)
+            self.assertEqual('Request body must be a JSON object', 
+                             json.loads(r.data)['error'])
+        
+    def test_inactive_user(self):
+        r = self.json_authenticate("tiya", "password")
+        self.assertEqual(403, r.status_code)
+        
+    def test_logout(self):
+        self.json_authenticate("matt", "password")
+        r = self.client.post('/logout.json', 
+                             headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(204, r.status_code)
+        r = self._get('/profile', follow_redirects=True)
+        self.assertIn('Please log in to access this page', r.data)
+        
+    def test_logout_requires_custom_header(self):
+        self.json_authenticate("matt", "password")
+        r = self.client.post('/logout.json')
+        self.assertEqual(403, r.status_code)
+        self.assertIn('Profile Page', self._get('/profile').data)
+
+
+class CountingContext(object):
+    
+    def __init__(self, context):
+        self.context = context
+        self.verified = 0
+        
+    def verify(self, *args, **kwargs):
+        self.verified += 1
+        return self.context.verify(*args, **kwargs)
+    
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+
+class HttpAuthSecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_CREDENTIAL_CACHE_TTL': 60
+    }
+    
+    def setUp(self):
+        super(HttpAuthSecurityTests, self).setUp()
+        state = self.app.security
+        state.pwd_context = CountingContext(state.pwd_context)
+        
+    def test_missing_credentials(self):
+        r = self._get('/http')
+        self.assertEqual(401, r.status_code)
+        self.assertEqual('Basic realm="Login Required"', 
+                         r.headers['WWW-Authenticate'])
+        
+    def test_authenticate(self):
+        r = self.http_get('matt', 'password')
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('HTTP Authentication: matt', r.data)
+        self.assertIn('Please log in', 
+                      self._get('/profile', follow_redirects=True).data)
+        
+    def test_bad_password_and_inactive_user(self):
+        self.assertEqual(401, self.http_get('matt', 'bogus').status_code)
+        self.assertEqual(401, self.http_get('tiya', 'password').status_code)
+        self.assertEqual(401, self.http_get('tiya', 'password').status_code)
+        
+    def test_verified_credentials_are_cached(self):
+        for i in range(3):
+            self.assertEqual(200, self.http_get('matt', 'password').status_code)
+        self.assertEqual(200, self.http_get('MATT', 'password').status_code)
+        self.assertEqual(1, self.app.security.pwd_context.verified)
+        
+        self.assertEqual(401, self.http_get('matt', 'bogus').status_code)
+        self.assertEqual(401, self.http_get('matt', 'bogus').status_code)
+        self.assertEqual(3, self.app.security.pwd_context.verified)
+        
+    def test_password_change_invalidates_cached_credentials(self):
+        self.http_get('matt', 'password')
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            matt = datastore.find_user('matt')
+            matt.password = 'changed'
+            datastore._save_user(matt)
+            
+        self.assertEqual(401, self.http_get('matt', 'password').status_code)
+        self.assertEqual(200, self.http_get('matt', 'changed').status_code)
+        
+    def test_deactivation_invalidates_cached_credentials(self):
+        self.http_get('matt', 'password')
+        with self.app.test_request_context():
+            self.app.user_datastore.deactivate_users(users=['matt'])
+        self.assertEqual(401, self.http_get('matt', 'password').status_code)
+
+
+class ApiKeySecurityTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_AUTH_PROVIDER': 
+            'flask.ext.security.ApiKeyAuthenticationProvider',
+        'SECURITY_TRACKABLE_FLUSH_INTERVAL': 60
+    }
+    
+    def setUp(self):
+        super(ApiKeySecurityTests, self).setUp()
+        state = self.app.security
+        state.pwd_context = CountingContext(state.pwd_context)
+        self._get('/')
+        with self.app.test_request_context():
+            self.key = self.app.user_datastore.issue_api_key('matt')
+            
+    def test_authenticate(self):
+        r = self.http_get('matt', self.key)
+        self.assertEqual('HTTP Authentication: matt', r.data)
+        self.assertEqual(200, self.http_get('MATT@lp.com', self.key).status_code)
+        self.assertEqual(0, self.app.security.pwd_context.verified)
+        
+    def test_bad_credentials(self):
+        self.assertEqual(401, self.http_get('matt', 'password').status_code)
+        self.assertEqual(401, self.http_get('joe', self.key).status_code)
+        r = self.authenticate('matt', 'password')
+        self.assertIn('API key does not match', r.data)
+        
+    def test_login_form(self):
+        r = self.authenticate('matt', self.key)
+        self.assertIn('Home Page', r.data)
+        
+    def test_rotate_and_revoke(self):
+        with self.app.test_request_context():
+            datastore = self.app.user_datastore
+            key = datastore.rotate_api_key('matt')
+            self.assertRaises(UserDatastoreError, 
+                              datastore.rotate_api_key, 'joe')
+        self.assertEqual(401, self.http_get('matt', self.key).status_code)
+        self.assertEqual(200, self.http_get('matt', key).status_code)
+        
+        with self.app.test_request_context():
+            self.app.user_datastore.revoke_api_key('matt')
+        self.assertEqual(401, self.http_get('matt', key).status_code)
+        
+    def test_uses_are_recorded_in_batches(self):
+        self.http_get('matt', self.key)
+        self.http_get('matt', self.key)
+        with self.app.test_request_context():
+            matt = self.app.user_datastore.find_user('matt')
+            self.assertIsNone(matt.api_key_last_used_at)
+            
+        self.app.security.api_key_tracker.flush()
+        
+        with self.app.test_request_context():
+            matt = self.app.user_datastore.find_user('matt')
+            self.assertIsNotNone(matt.api_key_last_used_at)
+            self.assertEqual(64, len(matt.api_key_digest))
+            self.assertNotIn(self.key, matt.api_key_digest)
+
+
+class SlowAuthSecurityTests(SecurityTest):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmpdir, 'slow_auth.log')
+        self.AUTH_CONFIG = {
+            'SECURITY_SLOW_AUTH_THRESHOLD': 0,
+            'SECURITY_SLOW_AUTH_LOG': self.log_path,
+            'SECURITY_AUTH_PROFILE_RATE': 1.0,
+            'SECURITY_AUTH_PROFILE_DIR': self.tmpdir
+        }
+        super(SlowAuthSecurityTests, self).setUp()
+        
+    def tearDown(self):
+        super(SlowAuthSecurityTests, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+        
+    def test_slow_authentication_is_logged(self):
+        self.authenticate('matt', 'password')
+        with open(self.log_path) as f:
+            record = json.loads(f.readlines()[-1])
+        self.assertEqual('auth.authenticate', record['endpoint'])
+        self.assertEqual(302, record['status'])
+        self.assertTrue(record['authenticated'])
+        for phase in ('form', 'find_user', 'verify', 'login_user', 
+                      'identity_changed'):
+            self.assertIn(phase, record['phases'])
+        self.assertTrue(os.path.exists(record['profile']))
+        
+    def test_records_are_logged_without_a_log_file(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        slow_auth_logger.addHandler(handler)
+        slow_auth_logger.setLevel(logging.NOTSET)
+        try:
+            AuthProfiler(threshold=0)
+            self.authenticate('matt', 'password')
+        finally:
+            slow_auth_logger.removeHandler(handler)
+        self.assertEqual('auth.authenticate', 
+                         json.loads(records[-1].getMessage())['endpoint'])
+
+
+class MultiAppSecurityTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.apps = [self._create_tenant_app(name) for name in ('a', 'b')]
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def _create_tenant_app(self, name):
+        tenant = app.create_app(None)
+        tenant.debug = False
+        tenant.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % \
+            os.path.join(self.tmpdir, '%s.sqlite' % name)
+        db = SQLAlchemy(tenant)
+        Security(tenant, SQLAlchemyUserDatastore(db))
+        db.create_all()
+        with tenant.test_request_context():
+            user_datastore.create_role(name='admin')
+            user_datastore.create_user(username=name, password='password', 
+                                       roles=['admin'])
+        return tenant
+        
+    def test_models_are_registered_per_app(self):
+        a, b = [tenant.security.datastore for tenant in self.apps]
+        self.assertIsNot(a.User, b.User)
+        
+        with self.apps[0].test_request_context():
+            self.assertEqual('a', user_datastore.find_user('a').username)
+            self.assertRaises(UserNotFoundError, user_datastore.find_user, 'b')
+            self.assertTrue(user_datastore.add_role_to_user('a', 'admin'))
+            
+        with self.apps[1].test_request_context():
+            self.assertRaises(UserNotFoundError, user_datastore.find_user, 'a')
+            user = user_datastore.find_user('b')
+            self.assertIsInstance(user, b.User)
+            self.assertTrue(user.has_role('admin'))
+            
+    def test_login_per_app(self):
+        for name, tenant in zip(('a', 'b'), self.apps):
+            client = tenant.test_client()
+            r = client.post('/auth', data=dict(username=name, 
+                                               password='password'), 
+                            follow_redirects=True)
+            self.assertIn('Hello', r.data)
+            self.assertIn('Admin Page', client.get('/admin').data)
+
+
+class ShardedDatastoreTests(unittest.TestCase):
+    
+    USERS = ['user%s' % i for i in range(20)]
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        
+        self.app = app.create_app(None)
+        self.app.debug = False
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = self.path('main.sqlite')
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'users0': self.path('users0.sqlite'), 
+            'users1': self.path('users1.sqlite')
+        }
+        self.shards = []
+        for key in ('users0', 'users1'):
+            db = SQLAlchemy(self.app)
+            self.shards.append(SQLAlchemyUserDatastore(db, bind_key=key))
+        self.datastore = ShardedUserDatastore(self.shards)
+        Security(self.app, self.datastore)
+        for shard in self.shards:
+            shard.db.create_all()
+        
+        with self.app.test_request_context():
+            self.datastore.create_role(name='admin')
+            self.datastore.create_role(name='editor', implied_roles=['admin'])
+            for name in self.USERS:
+                self.datastore.create_user(username=name, password='password',
+                                           email='%s@lp.com' % name, 
+                                           roles=['editor'])
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def path(self, name):
+        return 'sqlite:///%s' % os.path.join(self.tmpdir, name)
+        
+    def test_jump_hash(self):
+        keys = range(0, 10 ** 12, 10 ** 9)
+        before = [jump_hash(key, 4) for key in keys]
+        after = [jump_hash(key, 5) for key in keys]
+        moved = [b for a, b in zip(before, after) if a != b]
+        self.assertTrue(all(0 <= b < 4 for b in before))
+        self.assertEqual(set([4]), set(moved))
+        
+    def test_users_are_routed_to_their_shard(self):
+        with self.app.test_request_context():
+            counts = [len(list(shard.iter_users())) for shard in self.shards]
+            self.assertEqual(20, sum(counts))
+            self.assertTrue(all(counts))
+            
+            for name in self.USERS:
+                user = self.datastore.find_user(name.upper())
+                index = self.datastore.shard_index(name)
+                self.assertIsInstance(user, self.shards[index].User)
+                self.assertEqual('%s:%s' % (index, user.id), user.get_id())
+                self.assertEqual(user, self.datastore.with_id(user.get_id()))
+                self.assertEqual(user, 
+                                 self.datastore.find_user('%s@lp.com' % name))
+                self.assertTrue(user.has_role('admin'))
+                
+    def test_search_users_across_shards(self):
+        with self.app.test_request_context():
+            found, cursor = [], None
+            while True:
+                users, cursor = self.datastore.search_users(
+                    'user1', roles=['editor'], limit=3, cursor=cursor)
+                found.extend(u['username'] for u in users)
+                if cursor is None:
+                    break
+            expected = ['user1'] + ['user1%s' % i for i in range(10)]
+            self.assertEqual(sorted(expected), sorted(found))
+            
+    def test_roles_are_replicated(self):
+        with self.app.test_request_context():
+            self.datastore.create_role(name='author')
+            self.assertEqual(20, self.datastore.delete_role('editor'))
+            for shard in self.shards:
+                self.assertEqual(['admin', 'author'], 
+                                 sorted(r.name for r in shard.Role.query))
+            
+    def test_login(self):
+        client = self.app.test_client()
+        client.post('/auth', data=dict(username='user7', password='password'))
+        self.assertIn('Admin Page', client.get('/admin').data)
+        
+    def test_identity_uses_global_ids(self):
+        @self.app.route('/needs')
+        def needs():
+            return ','.join(sorted(n.value for n in g.identity.provides 
+                                   if n.method == 'name'))
+        
+        client = self.app.test_client()
+        client.post('/auth', data=dict(username='user7', password='password'))
+        with self.app.test_request_context():
+            user = self.datastore.find_user('user7')
+            self.assertEqual(user.get_id(), client.get('/needs').data)
+        
+    def test_add_shard_and_rebalance(self):
+        with self.app.test_request_context():
+            self.datastore.role_bitmask = True
+            self.datastore.sync_role_masks()
+            bits = self.datastore.get_role_bits()
+            # a shard whose bits differ from the first shard's
+            Role = self.shards[1].Role
+            Role.query.update({'bit': None})
+            Role.query.filter_by(name='admin').update({'bit': bits['editor']})
+            Role.query.filter_by(name='editor').update({'bit': bits['admin']})
+            self.shards[1].sync_role_masks()
+            
+            self.app.config['SQLALCHEMY_BINDS']['users2'] = \
+                self.path('users2.sqlite')
+            shard = SQLAlchemyUserDatastore(SQLAlchemy(self.app), 
+                                            bind_key='users2')
+            self.assertEqual(2, self.datastore.add_shard(shard))
+            shard.db.create_all()
+            
+            moved = self.datastore.rebalance()
+            self.assertTrue(0 < moved < 20)
+            self.assertEqual(moved, len(list(shard.iter_users())))
+            for datastore in self.datastore.shards:
+                self.assertEqual(bits, dict((r.name, 1 << r.bit) 
+                                            for r in datastore.Role.query))
+                self.assertEqual(frozenset(['admin', 'editor']), 
+                                 datastore.get_effective_roles(['editor']))
+            
+            for name in self.USERS:
+                user = self.datastore.find_user(name)
+                index = self.datastore.shard_index(name)
+                self.assertIsInstance(user, self.datastore.shards[index].User)
+                self.assertEqual(bits['editor'], user.role_mask)
+                self.assertEqual(frozenset(['editor']), 
+                                 user.get_role_names())
+                self.assertTrue(user.has_role('admin'))
+        
+    def test_rebalance(self):
+        with self.app.test_request_context():
+            source = self.shards[0]
+            for name in ('extra%s' % i for i in range(10)):
+                source.create_user(username=name, password='password', 
+                                   roles=['editor'])
+            
+            moved = self.datastore.rebalance()
+            self.assertTrue(0 < moved < 10)
+            self.assertEqual(0, self.datastore.rebalance())
+            
+            for name in ('extra%s' % i for i in range(10)):
+                user = self.datastore.find_user(name)
+                index = self.datastore.shard_index(name)
+                self.assertIsInstance(user, self.shards[index].User)
+                self.assertEqual(['editor'], user.get_role_names())
+                self.assertEqual(user.password, 
+                                 self.datastore.find_user('user0').password)
+                
+    def test_interrupted_rebalance_resumes(self):
+        with self.app.test_request_context():
+            source = self.shards[0]
+            names = ['extra%s' % i for i in range(10)]
+            for name in names:
+                source.create_user(username=name, password='password', 
+                                   roles=['editor'])
+            
+            # the first user is copied but not deleted from its old shard
+            delete_users = source.delete_users
+            def interrupt(**kwargs):
+                raise IOError('connection lost')
+            source.delete_users = interrupt
+            self.assertRaises(IOError, self.datastore.rebalance)
+            source.delete_users = delete_users
+            
+            self.assertTrue(0 < self.datastore.rebalance() < 10)
+            self.assertEqual(0, self.datastore.rebalance())
+            usernames = [u['username'] for u in self.datastore.iter_users()]
+            for name in names:
+                self.assertEqual(1, usernames.count(name))
+
+
+class SQLAlchemyDatastoreTests(SecurityTest):
+    
+    def setUp(self):
+        super(SQLAlchemyDatastoreTests, self).setUp()
+        self._get('/')
+        self.datastore = self.app.user_datastore
+        
+    @unittest.skipUnless(hasattr(Flask, 'app_context'), 
+                         'application contexts require Flask 0.9')
+    def test_proxies_in_application_context(self):
+        with self.app.app_context():
+            self.assertIs(self.datastore, user_datastore._get_current_object())
+            self.assertTrue(self.datastore.find_user('matt').has_role('admin'))
+            
+    def test_load_user_defers_unlisted_columns(self):
+        with self.app.test_request_context():
+            user_id = self.datastore.find_user('matt').id
+            self.datastore.db.session.expunge_all()
+            
+            user = self.datastore.load_user(user_id)
+            self.assertNotIn('password', user.__dict__)
+            self.assertIn('roles', user.__dict__)
+            self.assertEqual('password', user.password)
+            
+    def test_normalize_identifiers(self):
+        with self.app.test_request_context():
+            self.datastore.create_user(username=u'\xc4rne', 
+                                       email='arne@lp.com', password='password')
+            User = self.datastore.find_user('matt').__class__
+            User.query.update({'username_lower': None, 'email_lower': None})
+            # a process started after upgrading
+            self.datastore._unnormalized_users = None
+            
+            # users are found until the normalized fields are populated
+            self.assertEqual('joe', self.datastore.find_user('JOE').username)
+            
+            self.assertEqual(5, self.datastore.normalize_identifiers())
+            self.assertEqual('joe', self.datastore.find_user('JOE').username)
+            self.assertEqual('arne@lp.com', 
+                             self.datastore.find_user(u'\xe4RNE').email)
+            
+    def test_case_insensitive_duplicates_are_rejected(self):
+        with self.app.test_request_context():
+            for username, email in (('MATT', 'm@lp.com'), ('m', 'Joe@LP.com'),
+                                    ('joe@lp.com', 'j@lp.com')):
+                self.assertRaises(UserCreationError, 
+                                  self.datastore.create_user, username=username,
+                                  email=email, password='password')
+            
+    def test_iter_users(self):
+        with self.app.test_request_context():
+            users = list(self.datastore.iter_users(chunk_size=3))
+            self.assertEqual(['matt', 'joe', 'jill', 'tiya'], 
+                             [u['username'] for u in users])
+            self.assertEqual(['admin'], users[0]['roles'])
+            self.assertEqual([], users[3]['roles'])
+            
+            users = self.datastore.iter_users(roles=['editor', 'author'])
+            self.assertEqual(['joe', 'jill'], [u['username'] for u in users])
+            
+    def test_export_users_command(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            jsonl, csv_path = [os.path.join(tmpdir, name) 
+                               for name in ('users.jsonl', 'users.csv')]
+            with self.app.test_request_context():
+                command = ExportUsersCommand()
+                command.run('jsonl', jsonl, '', 3)
+                command.run('csv', csv_path, 'editor, author', 3)
+            
+            with open(jsonl) as f:
+                users = [json.loads(line) for line in f]
+            self.assertEqual(['matt', 'joe', 'jill', 'tiya'], 
+                             [u['username'] for u in users])
+            self.assertEqual(['admin'], users[0]['roles'])
+            self.assertEqual('matt@lp.com', users[0]['email'])
+            self.assertTrue(users[0]['active'])
+            self.assertFalse(users[3]['active'])
+            datetime.strptime(users[0]['created_at'], '%Y-%m-%dT%H:%M:%S.%f')
+            
+            with open(csv_path) as f:
+                reader = csv.DictReader(f)
+                rows = list(reader)
+            self.assertEqual(list(ExportUsersCommand.fields), 
+                             reader.fieldnames)
+            self.assertEqual([('joe', 'editor'), ('jill', 'author')], 
+                             [(r['username'], r['roles']) for r in rows])
+            self.assertEqual('True', rows[0]['active'])
+        finally:
+            shutil.rmtree(tmpdir)
+            
+    def test_search_users(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            for i in range(10):
+                ds.create_user(username='mark%s' % i, password='password',
+                               email='m%s@example.com' % i, roles=['author'],
+                               active=i % 2 == 0)
+                
+            names, cursor, pages = [], None, 0
+            while True:
+                users, cursor = ds.search_users('MA', limit=3, cursor=cursor)
+                names.extend(u['username'] for u in users)
+                pages += 1
+                if cursor is None:
+                    break
+            self.assertEqual(4, pages)
+            self.assertEqual(['matt'] + ['mark%s' % i for i in range(10)], names)
+            
+            users, cursor = ds.search_users('ma', roles=['author'], 
+                                            active=False)
+            self.assertEqual(['mark%s' % i for i in (1, 3, 5, 7, 9)], 
+                             [u['username'] for u in users])
+            self.assertIsNone(cursor)
+            self.assertEqual(['author'], users[0]['roles'])
+            
+            users, cursor = ds.search_users('jill@')
+            self.assertEqual(['jill'], [u['username'] for u in users])
+            self.assertEqual(4 + 10, len(ds.search_users(limit=100)[0]))
+            self.assertRaises(UserDatastoreError, ds.search_users, 
+                              cursor='bogus')
+            self.assertRaises(UserDatastoreError, ds.search_users, ' M ')
+            
+    def test_bulk_activation(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            self.assertEqual(2, ds.deactivate_users(users=['matt', 'JOE@lp.com'], 
+                                                    roles=['editor']))
+            self.assertEqual(0, ds.deactivate_users(users=['matt']))
+            self.assertFalse(ds.find_user('joe').active)
+            self.assertTrue(ds.find_user('jill').active)
+            
+            self.assertEqual(3, ds.activate_users(users=['tiya'], 
+                                                  roles=['admin', 'editor']))
+            self.assertTrue(ds.find_user('matt').active)
+            self.assertTrue(ds.find_user('tiya').active)
+            
+            self.assertRaises(UserDatastoreError, ds.activate_users)
+            
+    def test_delete_users(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            self.assertEqual(2, ds.delete_users(users=['tiya'], 
+                                                roles=['author']))
+            self.assertRaises(UserNotFoundError, ds.find_user, 'jill')
+            self.assertEqual(0, ds.find_role('author').users.count())
+            self.assertEqual(2, len(ds.db.session.execute(
+                ds.roles_users.select()).fetchall()))
+            
+            ds.delete_user('matt')
+            self.assertRaises(UserNotFoundError, ds.find_user, 'matt')
+            self.assertRaises(UserNotFoundError, ds.delete_user, 'matt')
+            self.assertEqual(['joe'], [u['username'] for u in ds.iter_users()])
+            
+    def test_delete_role(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            ds.add_implied_role('admin', 'editor')
+            ds.add_role_to_user('matt', 'editor')
+            
+            self.assertEqual(2, ds.delete_role('editor'))
+            self.assertRaises(RoleNotFoundError, ds.find_role, 'editor')
+            self.assertEqual([], ds.find_user('joe').roles)
+            self.assertEqual(['admin'], ds.find_user('matt').get_role_names())
+            self.assertEqual([], ds.find_role('admin').implied_roles)
+            self.assertEqual(frozenset(['admin']), 
+                             ds.get_effective_roles(['admin']))
+
+
+
+class MongoEngineDatastoreTests(SecurityTest):
+    
+    AUTH_CONFIG = {
+        'SECURITY_ROLE_BITMASK': True
+    }
+    
+    def _create_app(self, auth_config):
+        return app.create_mongoengine_app(auth_config)
+    
+    def setUp(self):
+        super(MongoEngineDatastoreTests, self).setUp()
+        self._get('/')
+        self.datastore = self.app.user_datastore
+        
+    def test_ensure_indexes(self):
+        collection = self.datastore.User._get_collection()
+        collection.drop_indexes()
+        with self.app.test_request_context():
+            EnsureIndexesCommand().run()
+        indexes = dict((tuple(key for key, _ in info['key']), info) 
+                       for info in collection.index_information().values())
+        for field in ('username_lower', 'email_lower'):
+            self.assertTrue(indexes[(field,)]['unique'])
+            self.assertTrue(indexes[(field,)]['sparse'])
+        for fields in (('username',), ('email',), 
+                       ('_types', 'last_login_at'), 
+                       ('_types', 'api_key_digest')):
+            self.assertIn(fields, indexes)
+        
+    def test_bulk_activation(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            self.assertEqual(2, ds.deactivate_users(users=['matt', 'JOE@lp.com'], 
+                                                    roles=['editor']))
+            self.assertEqual(0, ds.deactivate_users(users=['matt']))
+            self.assertFalse(ds.find_user('joe').active)
+            self.assertTrue(ds.find_user('jill').active)
+            
+            self.assertEqual(3, ds.activate_users(users=['tiya'], 
+                                                  roles=['admin', 'editor']))
+            self.assertTrue(ds.find_user('matt').active)
+            self.assertTrue(ds.find_user('tiya').active)
+            
+    def test_delete_users(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            self.assertEqual(2, ds.delete_users(users=['tiya'], 
+                                                roles=['author']))
+            self.assertRaises(UserNotFoundError, ds.find_user, 'jill')
+            
+            ds.delete_user('matt')
+            self.assertRaises(UserNotFoundError, ds.delete_user, 'matt')
+            self.assertEqual(['joe'], [u['username'] for u in ds.iter_users()])
+            
+    def test_delete_role(self):
+        with self.app.test_request_context():
+            ds = self.datastore
+            bits = ds.get_role_bits()
+            ds.add_implied_role('admin', 'editor')
+            ds.add_role_to_user('matt', 'editor')
+            # a mask that is out of sync must not be corrupted
+            ds.User.objects(username='matt').update_one(
+                set__role_mask=bits['admin'])
+            
+            self.assertEqual(2, ds.delete_role('editor'))
+            self.assertRaises(RoleNotFoundError, ds.find_role, 'editor')
+            self.assertEqual([], ds.find_user('joe').roles)
+            self.assertEqual(0, ds.find_user('joe').role_mask)
+            matt = ds.find_user('matt')
+            self.assertEqual(['admin'], [r.name for r in matt.roles])
+            self.assertEqual(bits['admin'], matt.role_mask)
+            self.assertEqual([], ds.find_role('admin').implied_roles)
+
         
 class MongoEngineSecurityTests(DefaultSecurityTests):
     
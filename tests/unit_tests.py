@@ -1,6 +1,17 @@
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import time
 import unittest
 import flask_security
-from flask_security import RoleMixin, UserMixin, AnonymousUser
+from flask import Flask
+from flask_security.cache import SQLiteCache
+from flask_security.datastore import compute_role_closure
+from flask_security.invalidation import SQLiteInvalidationBus
+from flask_security import (RoleMixin, UserMixin, AnonymousUser, 
+                            get_bus_options, get_cache_options)
 
 class Role(RoleMixin):
     def __init__(self, name, description=None):
@@ -41,4 +52,85 @@ class SecurityEntityTests(unittest.TestCase):
     def test_anonymous_user_has_no_roles(self):
         au = AnonymousUser()
         self.assertEqual(0, len(au.roles))
-        self.assertFalse(au.has_role('admin'))
\ No newline at end of file
+        self.assertFalse(au.has_role('admin'))
+        
+    def test_compute_role_closure(self):
+        closure = compute_role_closure({'admin': ['editor'], 
+                                        'editor': ['author'],
+                                        'author': ['editor']})
+        self.assertEqual(set(['admin', 'editor', 'author']), closure['admin'])
+        self.assertEqual(set(['editor', 'author']), closure['author'])
+        
+        
+class SQLiteCacheTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.cache = SQLiteCache('/tmp/flask_security_test_cache.sqlite', 
+                                 key_prefix='unit.')
+        self.cache.clear()
+        
+    def test_set_and_get(self):
+        self.cache.set('a', {'roles': ['admin']})
+        self.assertEqual({'roles': ['admin']}, self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        
+    def test_expired_entries_are_not_returned(self):
+        self.cache.set('a', 1, timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('a'))
+        
+    def test_delete_many(self):
+        self.cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.cache.delete_many('a', 'b')
+        self.assertEqual([None, None, 3], self.cache.get_many('a', 'b', 'c'))
+        
+    def test_shared_between_instances(self):
+        self.cache.set('a', 1)
+        other = SQLiteCache(self.cache.path, key_prefix='unit.')
+        self.assertEqual(1, other.get('a'))
+        
+    def test_values_are_not_unpickled(self):
+        self.cache._execute('INSERT INTO cache (key, value, expires) VALUES '
+                            '(?, ?, ?)', 'unit.a', pickle.dumps({'a': 1}), 
+                            time.time() + 60)
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', {'id': 1, 'roles': ('admin',)})
+        self.assertEqual({'id': 1, 'roles': ['admin']}, self.cache.get('a'))
+        
+    def test_path_is_required(self):
+        self.assertRaises(ValueError, SQLiteCache, None)
+        
+    def test_options_default_to_the_application(self):
+        app = Flask(__name__)
+        options = get_cache_options(SQLiteCache, {}, app, object())
+        self.assertEqual('%s.object.' % app.name, options['key_prefix'])
+        self.assertEqual(app.instance_path, os.path.dirname(options['path']))
+        options = get_cache_options(SQLiteCache, {'key_prefix': '', 
+                                                  'path': '/a/b'}, app, None)
+        self.assertEqual({'key_prefix': '', 'path': '/a/b'}, options)
+
+
+class SQLiteInvalidationBusTests(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        
+    def test_path_is_required(self):
+        self.assertRaises(ValueError, SQLiteInvalidationBus, None)
+        
+    def test_file_is_private(self):
+        path = os.path.join(self.tmpdir, 'bus', 'invalidation.sqlite')
+        SQLiteInvalidationBus(path)
+        self.assertEqual(0600, stat.S_IMODE(os.stat(path).st_mode))
+        self.assertEqual(0700, 
+                         stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode))
+        
+    def test_options_default_to_the_application(self):
+        app = Flask(__name__)
+        options = get_bus_options(SQLiteInvalidationBus, {}, app)
+        self.assertEqual(app.instance_path, os.path.dirname(options['path']))
+        options = get_bus_options(SQLiteInvalidationBus, {'path': '/a/b'}, app)
+        self.assertEqual({'path': '/a/b'}, options)